@@ -1,8 +1,14 @@
 import eventlet
 eventlet.monkey_patch()
 
-from flask import Flask, jsonify, request, send_file, send_from_directory
-from flask_socketio import SocketIO, emit
+from eventlet import tpool, wsgi as eventlet_wsgi
+from eventlet.semaphore import Semaphore
+from eventlet.event import Event
+from eventlet.hubs import trampoline
+
+from flask import Flask, Response, g, jsonify, request
+from flask_socketio import SocketIO, emit, join_room, leave_room
+from markupsafe import escape
 from datetime import datetime, timezone
 import os
 from pathlib import Path
@@ -10,9 +16,58 @@ from dotenv import load_dotenv
 import logging
 import uuid
 import json
+import base64
+import re
+import hashlib
+import hmac
+import mimetypes
+import shutil
+import ssl
+import time
+import functools
+import gzip
+import atexit
+import bisect
+import struct
+import sys
+import tempfile
+import traceback
+from urllib.parse import quote
+import sqlite3
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, deque
 import requests
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -27,10 +82,59 @@ app.config['MAX_CONTENT_LENGTH'] = 12 * 1024 * 1024
 @app.after_request
 def add_cors_headers(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, HEAD, POST, PUT, PATCH, DELETE, OPTIONS'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Upload-Offset'
+    response.headers['Access-Control-Expose-Headers'] = 'Upload-Offset, Upload-Length, X-Download-Token, X-Download-Url'
     return response
 
+# --- PAGES ---
+# HTML pages are rendered once at startup. Static ones keep gzip and brotli
+# variants ready to send, so a flood of scanner 404s costs one dict lookup per
+# hit. Pages with per-request values keep their fixed parts as bytes and only
+# escape and splice in the values.
+CACHE_CONTROL_ERROR_PAGES = os.getenv('CACHE_CONTROL_ERROR_PAGES', 'public, max-age=60')
+PAGE_FIELD_PATTERN = re.compile('\x00(\\w+)\x00')
+
+def page_field(name):
+    return f'\x00{name}\x00'
+
+class StaticPage:
+    def __init__(self, html, cache_control=None):
+        body = html.encode()
+        self.cache_control = cache_control
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {'identity': body, 'gzip': gzip.compress(body, 9)}
+        if brotli:
+            self.variants['br'] = brotli.compress(body, quality=11)
+
+    def response(self, status=200):
+        encoding = request.accept_encodings.best_match(list(self.variants), default='identity')
+        etag = self.etag if encoding == 'identity' else f'{self.etag}-{encoding}'
+        if status == 200 and request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(self.variants[encoding], status, mimetype='text/html')
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.set_etag(etag)
+        if self.cache_control:
+            response.headers['Cache-Control'] = self.cache_control
+        return response
+
+class PageTemplate:
+    def __init__(self, html):
+        pieces = PAGE_FIELD_PATTERN.split(html)
+        self.chunks = [piece.encode() for piece in pieces[0::2]]
+        self.fields = pieces[1::2]
+
+    def render(self, **values):
+        parts = [self.chunks[0]]
+        for field, chunk in zip(self.fields, self.chunks[1:]):
+            parts.append(str(escape(values[field])).encode())
+            parts.append(chunk)
+        return b''.join(parts)
+
 def get_error_page(error_code, error_title, error_message):
     return f"""
     <!DOCTYPE html>
@@ -186,39 +290,464 @@ def get_error_page(error_code, error_title, error_message):
     </html>
     """
 
-@app.errorhandler(404)
-def not_found_error(error):
-    return get_error_page(
+ERROR_PAGES = {
+    404: StaticPage(get_error_page(
         404,
         "Page Not Found",
         "The resource you are looking for does not exist or has been removed. Please check the URL and try again."
-    ), 404
-
-@app.errorhandler(405)
-def method_not_allowed_error(error):
-    return get_error_page(
+    ), CACHE_CONTROL_ERROR_PAGES),
+    405: StaticPage(get_error_page(
         405,
         "Method Not Allowed",
         "The request method is not allowed for this resource. This request has been blocked for security reasons."
-    ), 405
-
-@app.errorhandler(500)
-def internal_error(error):
-    return get_error_page(
+    ), CACHE_CONTROL_ERROR_PAGES),
+    500: StaticPage(get_error_page(
         500,
         "Server Error",
         "An internal server error occurred. Our team has been notified. Please try again later."
-    ), 500
+    ), 'no-store')
+}
+
+@app.errorhandler(404)
+def not_found_error(error):
+    return ERROR_PAGES[404].response(404)
+
+@app.errorhandler(405)
+def method_not_allowed_error(error):
+    return ERROR_PAGES[405].response(405)
+
+@app.errorhandler(500)
+def internal_error(error):
+    return ERROR_PAGES[500].response(500)
+
+# --- METRICS ---
+# Prometheus text format at GET /metrics. Samples are only recorded on the
+# eventlet hub thread, where greenlets switch at I/O and never mid-statement,
+# so the plain dict and list updates below need no lock.
+METRICS_PREFIX = 'oxcy_'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+AI_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+HTTP_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+metrics_registry = []
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = (
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), chr(92) + "n")}"'
+        for name, value in zip(names, values)
+    )
+    return '{' + ','.join(pairs) + '}'
+
+class Metric:
+    """One metric family. Series are keyed by their label values in `labels`
+    order. With `collect`, the series come from calling it at scrape time
+    instead, for numbers another component already keeps."""
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labels=(), collect=None):
+        self.name = METRICS_PREFIX + name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.values = {}
+        metrics_registry.append(self)
+
+    def samples(self):
+        values = self.collect() if self.collect else self.values
+        for key, value in values.items():
+            yield '', self.labels, key if isinstance(key, tuple) else (key,), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        for suffix, names, key, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(names, key)} {value}')
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels):
+        self.values[labels] = self.values.get(labels, 0) + 1
+
+    def add(self, amount, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def inc(self, *labels):
+        self.values[labels] = self.values.get(labels, 0) + 1
+
+    def dec(self, *labels):
+        self.values[labels] = self.values.get(labels, 0) - 1
+
+class Histogram(Metric):
+    """Per series, a count for each bucket (non-cumulative, the last one
+    being +Inf) followed by the sum of observed values. Buckets are only
+    summed up at scrape time."""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        bucket_labels = self.labels + ('le',)
+        for key, series in list(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                total += count
+                yield '_bucket', bucket_labels, key + (bound,), total
+            yield '_sum', self.labels, key, series[-1]
+            yield '_count', self.labels, key, total
+
+def timed(histogram, *labels):
+    """Decorator recording each call's duration in histogram."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *labels)
+        return wrapper
+    return decorator
+
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    lines.append('')
+    return '\n'.join(lines)
+
+HTTP_REQUESTS = Counter('http_requests_total', 'HTTP requests by method, route and status.', ('method', 'route', 'status'))
+HTTP_REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Time to produce an HTTP response, excluding streamed bodies.', ('method', 'route'))
+SOCKET_EVENTS = Counter('socketio_events_total', 'Socket.IO events handled.', ('event',))
+SOCKET_EVENT_SECONDS = Histogram('socketio_event_duration_seconds', 'Socket.IO event handler duration.', ('event',))
+SOCKETS_CONNECTED = Gauge('socketio_connected', 'Connected Socket.IO clients.')
+UPLOAD_BYTES = Counter('upload_bytes_total', 'Bytes received in file uploads.', ('kind',))
+DOWNLOAD_BYTES = Counter('download_bytes_total', 'File bytes served, by the app or the fronting server.', ('mode',))
+METADATA_SECONDS = Histogram('metadata_duration_seconds', 'Metadata store reads (load) and writes (save).', ('operation',))
+AI_UPSTREAM_SECONDS = Histogram('ai_upstream_duration_seconds', 'Groq latency: whole answer, stream start and whole stream.', ('stage',), AI_LATENCY_BUCKETS)
+AI_UPSTREAM_ERRORS = Counter('ai_upstream_errors_total', 'Non-200 answers from Groq.', ('status',))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        method = request.method if request.method in HTTP_METHODS else 'OTHER'
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method, route)
+        HTTP_REQUESTS.inc(method, route, str(response.status_code))
+    return response
+
+SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE') or None
+# Per-packet engine.io and Socket.IO logging, for debugging only.
+SOCKETIO_DEBUG = os.getenv('SOCKETIO_DEBUG', '').lower() in ('1', 'true', 'yes')
 
 socketio = SocketIO(
     app, 
     cors_allowed_origins="*", 
     async_mode='eventlet',
-    engineio_logger=True, 
-    logger=True,
+    message_queue=SOCKETIO_MESSAGE_QUEUE,
+    engineio_logger=SOCKETIO_DEBUG,
+    logger=SOCKETIO_DEBUG,
     always_connect=True
 )
 
+def run_socket_handler(name, handler, args):
+    started = time.perf_counter()
+    try:
+        return handler(*args)
+    finally:
+        SOCKET_EVENT_SECONDS.observe(time.perf_counter() - started, name)
+        SOCKET_EVENTS.inc(name)
+
+def socket_event(name):
+    """socketio.on(name) that also counts and times the handler."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args):
+            return run_socket_handler(name, handler, args)
+        return socketio.on(name)(wrapper)
+    return decorator
+
+# --- PROFILING ---
+# Both tools run on a native thread and read the hub thread's stack with
+# sys._current_frames(), which is whatever greenlet is running right then, so
+# the hub does no extra work per request or switch. A C call that holds the
+# GIL (some hashing, big json.dumps) also holds them off until it returns.
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+PROFILER_MAX_SECONDS = 600
+HUB_BLOCK_THRESHOLD_MS = float(os.getenv('HUB_BLOCK_THRESHOLD_MS', 0))
+HUB_BLOCK_HISTORY = 50
+
+native_threading = eventlet.patcher.original('threading')
+native_sleep = eventlet.patcher.original('time').sleep
+HUB_THREAD_ID = native_threading.get_ident()
+
+def admin_required(view):
+    """Admin endpoints need `Authorization: Bearer <ADMIN_TOKEN>` and do not
+    exist while ADMIN_TOKEN is unset."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({'error': 'Not found'}), 404
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return jsonify({'error': 'Unauthorized'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+def hub_frame():
+    return sys._current_frames().get(HUB_THREAD_ID)
+
+def frame_name(frame):
+    return f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}'
+
+def collapse_stack(frame):
+    """Outermost first, joined with ';' as in flamegraph.pl's folded format."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def handler_label(frame):
+    """The route or Socket.IO event a hub stack is serving, or the innermost
+    app.py function for background tasks."""
+    fallback = None
+    while frame is not None:
+        code = frame.f_code
+        if code is run_socket_handler.__code__:
+            return f"socketio {frame.f_locals.get('name')}"
+        if code is Flask.wsgi_app.__code__:
+            environ = frame.f_locals.get('environ') or {}
+            flask_request = environ.get('werkzeug.request')
+            rule = getattr(flask_request, 'url_rule', None)
+            # Not the raw path: it would give hub_blocks_total a label per URL.
+            return f"{environ.get('REQUEST_METHOD')} {rule.rule if rule else 'unmatched'}"
+        if fallback is None and code.co_filename == __file__:
+            fallback = code.co_name
+        frame = frame.f_back
+    return fallback or 'unknown'
+
+class SamplingProfiler:
+    """Counts the hub thread's stack every interval while running. Samples
+    taken while the hub sits idle in its poll are counted too, so a profile
+    shows how busy the process was as well as where."""
+
+    def __init__(self):
+        self.lock = native_threading.Lock()
+        self.stacks = {}
+        self.samples = 0
+        self.interval = 0
+        self.started_at = None
+        self.stopped = native_threading.Event()
+        self.stopped.set()
+
+    def running(self):
+        return not self.stopped.is_set()
+
+    def start(self, interval, seconds):
+        if self.running():
+            return False
+        with self.lock:
+            self.stacks = {}
+            self.samples = 0
+        self.interval = interval
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.stopped.clear()
+        native_threading.Thread(target=self.sample_forever, args=(interval, seconds), name='profiler', daemon=True).start()
+        return True
+
+    def stop(self):
+        self.stopped.set()
+
+    def sample_forever(self, interval, seconds):
+        deadline = time.monotonic() + seconds
+        while not self.stopped.wait(interval) and time.monotonic() < deadline:
+            frame = hub_frame()
+            if frame is None:
+                continue
+            stack = collapse_stack(frame)
+            with self.lock:
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+        self.stopped.set()
+
+    def collapsed(self):
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
+
+    def stats(self):
+        return {
+            'running': self.running(),
+            'started_at': self.started_at,
+            'interval_ms': self.interval * 1000,
+            'samples': self.samples,
+            'stacks': len(self.stacks)
+        }
+
+class HubWatchdog:
+    """Reports whatever holds the hub longer than the threshold. A greenlet
+    on the hub bumps a heartbeat; once it is overdue, a native thread records
+    the hub's stack and handler while the blocker still runs. The heartbeat
+    logs the block when the hub gets back to it, with the stack when one was
+    caught."""
+
+    def __init__(self, threshold_ms):
+        self.threshold = 0
+        self.last_beat = time.monotonic()
+        self.caught = None
+        self.lock = native_threading.Lock()
+        self.recent = deque(maxlen=HUB_BLOCK_HISTORY)
+        self.started = False
+        self.configure(threshold_ms)
+
+    def interval(self):
+        # While disabled both loops keep ticking slowly, so toggling is just
+        # a matter of setting the threshold.
+        return max(self.threshold / 4, 0.01) if self.threshold else 1
+
+    def configure(self, threshold_ms):
+        self.threshold = max(threshold_ms, 0) / 1000
+        if self.threshold and not self.started:
+            self.started = True
+            self.last_beat = time.monotonic()
+            socketio.start_background_task(self.heartbeat)
+            native_threading.Thread(target=self.watch, name='hub-watchdog', daemon=True).start()
+
+    def heartbeat(self):
+        while True:
+            interval = self.interval()
+            self.last_beat = time.monotonic()
+            eventlet.sleep(interval)
+            blocked = time.monotonic() - self.last_beat - interval
+            with self.lock:
+                caught, self.caught = self.caught, None
+            if not self.threshold or blocked < self.threshold:
+                continue
+            block = caught or {'handler': 'unknown', 'stack': None}
+            block.update({
+                'ended_at': datetime.now(timezone.utc).isoformat(),
+                'blocked_ms': round(blocked * 1000, 1)
+            })
+            self.recent.append(block)
+            HUB_BLOCKS.inc(block['handler'])
+            HUB_BLOCK_SECONDS.observe(blocked)
+            logger.warning(
+                'Hub blocked for %.0f ms by %s\n%s', blocked * 1000, block['handler'],
+                block['stack'] or '(stack not caught)'
+            )
+
+    def watch(self):
+        caught_beat = None
+        while True:
+            interval = self.interval()
+            native_sleep(interval)
+            last_beat = self.last_beat
+            if not self.threshold or last_beat == caught_beat:
+                continue
+            if time.monotonic() - last_beat - interval < self.threshold:
+                continue
+            frame = hub_frame()
+            if frame is None:
+                continue
+            caught_beat = last_beat
+            block = {'handler': handler_label(frame), 'stack': ''.join(traceback.format_stack(frame))}
+            with self.lock:
+                self.caught = block
+
+    def stats(self):
+        return {'threshold_ms': self.threshold * 1000, 'recent': list(self.recent)}
+
+HUB_BLOCKS = Counter('hub_blocks_total', 'Times the eventlet hub was held past HUB_BLOCK_THRESHOLD_MS, by handler.', ('handler',))
+HUB_BLOCK_SECONDS = Histogram('hub_block_duration_seconds', 'How long the eventlet hub was held, for blocks past the threshold.', buckets=AI_LATENCY_BUCKETS)
+
+profiler = SamplingProfiler()
+hub_watchdog = HubWatchdog(HUB_BLOCK_THRESHOLD_MS)
+
+# --- WORKER POOLS ---
+# Blocking calls (password hashes, whole-file hashing, fsync, big writes and
+# deletes) run on eventlet's native thread pool so the hub keeps serving. Each
+# kind of work gets its own bounded pool, so a burst of one cannot queue
+# another behind it; callers over the bound wait cooperatively on the hub.
+# hashlib and PBKDF2 release the GIL, so the threads hash in parallel.
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 4))
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', 2))
+DISK_WORKERS = int(os.getenv('DISK_WORKERS', 4))
+CHAT_LOG_WORKERS = 2
+
+worker_pools = {}
+
+class WorkerPool:
+    def __init__(self, name, size):
+        self.name = name
+        self.size = max(size, 1)
+        self.slots = Semaphore(self.size)
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        worker_pools[name] = self
+
+    def run(self, func, *args, **kwargs):
+        """func(*args, **kwargs) on a native thread, returning its result or
+        raising its exception in the calling greenlet."""
+        queued_at = time.perf_counter()
+        self.queued += 1
+        try:
+            self.slots.acquire()
+        finally:
+            self.queued -= 1
+        started = time.perf_counter()
+        WORKER_POOL_WAIT_SECONDS.observe(started - queued_at, self.name)
+        self.active += 1
+        try:
+            return tpool.execute(func, *args, **kwargs)
+        finally:
+            self.active -= 1
+            self.completed += 1
+            self.slots.release()
+            WORKER_POOL_TASK_SECONDS.observe(time.perf_counter() - started, self.name)
+
+    def stats(self):
+        return {'size': self.size, 'queued': self.queued, 'active': self.active, 'completed': self.completed}
+
+WORKER_POOL_WAIT_SECONDS = Histogram('worker_pool_wait_seconds', 'Time blocking work waited for a worker pool slot.', ('pool',))
+WORKER_POOL_TASK_SECONDS = Histogram('worker_pool_task_seconds', 'Time blocking work ran on a worker pool thread.', ('pool',))
+Gauge('worker_pool_queued', 'Blocking calls waiting for a worker pool slot.', ('pool',),
+      collect=lambda: {name: pool.queued for name, pool in worker_pools.items()})
+Gauge('worker_pool_active', 'Blocking calls running on worker pool threads.', ('pool',),
+      collect=lambda: {name: pool.active for name, pool in worker_pools.items()})
+Gauge('worker_pool_size', 'Worker pool thread limit.', ('pool',),
+      collect=lambda: {name: pool.size for name, pool in worker_pools.items()})
+
+password_pool = WorkerPool('password', PASSWORD_HASH_WORKERS)
+hash_pool = WorkerPool('hash', HASH_WORKERS)
+disk_pool = WorkerPool('disk', DISK_WORKERS)
+chat_log_pool = WorkerPool('chat_log', CHAT_LOG_WORKERS)
+# Enough native threads that no pool waits on another's.
+tpool.set_num_threads(sum(pool.size for pool in worker_pools.values()))
+
 PORT = int(os.getenv('PORT', 8001))
 LATEST_VERSION = os.getenv('LATEST_VERSION', '0.2.0')
 TUNNEL_URL = os.getenv('CLOUDFLARE_TUNNEL_URL', 'https://compounds-collecting-hammer-subscriber.trycloudflare.com')
@@ -230,94 +759,1584 @@ UPLOADS_DIR = Path('uploads')
 UPLOADS_DIR.mkdir(exist_ok=True)
 
 ALLOWED_EXTENSIONS = {'.dll', '.rar', '.zip', '.exe'}
-MAX_FILE_SIZE = 12 * 1024 * 1024
+# Single-request uploads are still capped by MAX_CONTENT_LENGTH; larger files go
+# through the resumable upload API in chunks of at most that size.
+MAX_FILE_SIZE = int(os.getenv('MAX_FILE_SIZE_MB', 12)) * 1024 * 1024
 MAX_FILES_PER_USER = 5
+# Total size of one user's files, 0 for no limit.
+MAX_BYTES_PER_USER = int(os.getenv('MAX_STORAGE_PER_USER_MB', 0)) * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_SESSION_TTL = int(os.getenv('UPLOAD_SESSION_TTL_HOURS', 24)) * 3600
+UPLOAD_SESSION_FILE = '.upload.json'
+UPLOAD_PART_FILE = '.upload.part'
+FILE_ID_PATTERN = re.compile(r'[0-9a-f]{8}')
+
+# Upload contents are stored once per SHA-256 under blobs/<aa>/<sha256>; file_ids
+# in the metadata store reference them and carry the user-facing name.
+BLOBS_DIR = UPLOADS_DIR / 'blobs'
+BLOBS_TMP_DIR = BLOBS_DIR / 'tmp'
+BLOBS_TMP_DIR.mkdir(parents=True, exist_ok=True)
+# Temp files and unreadable upload sessions untouched for this long are left
+# over from a crash. Younger ones may belong to another worker.
+STALE_TEMP_AGE = 3600
+STARTUP_LOCK_PATH = UPLOADS_DIR / '.startup.lock'
+
+@contextmanager
+def startup_lock():
+    """Runs one-off startup work (imports, migrations, cleanup) in one worker
+    at a time when several share UPLOADS_DIR. Without fcntl (Windows) it
+    does not lock."""
+    with open(STARTUP_LOCK_PATH, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def is_stale(path):
+    try:
+        return time.time() - path.stat().st_mtime > STALE_TEMP_AGE
+    except FileNotFoundError:
+        return False
+
+class UploadTooLarge(Exception):
+    pass
+
+def stream_to_temp(stream, limit):
+    """Copy an upload stream to a temp file in UPLOAD_CHUNK_SIZE pieces, so memory
+    stays bounded by one chunk, hashing as it goes and giving up as soon as the
+    stream grows past limit. Returns (tmp_path, size, sha256 hex digest)."""
+    tmp_path = BLOBS_TMP_DIR / f'{uuid.uuid4().hex}.part'
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > limit:
+                    raise UploadTooLarge()
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return tmp_path, size, digest.hexdigest()
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_at(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+    return offset
+
+def max_file_size_label():
+    return f'{MAX_FILE_SIZE // (1024 * 1024)} MB'
+
+# --- METADATA STORE ---
+METADATA_BACKEND = os.getenv('METADATA_BACKEND', 'sqlite').lower()
+METADATA_DB_PATH = Path(os.getenv('METADATA_DB_PATH', 'uploads/metadata.db'))
 
 files_metadata_path = Path('uploads/metadata.json')
 
-def load_files_metadata():
-    if files_metadata_path.exists():
+FILE_FIELDS = (
+    'file_id', 'original_name', 'current_name', 'size', 'uploaded_at',
+    'user_ip', 'password_hash', 'is_password_protected', 'sha256'
+)
+
+class JsonMetadataStore:
+    """Legacy backend: the whole index lives in uploads/metadata.json and is
+    rewritten on every change. Kept for setups that edit the file by hand."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._files = self._load()
+        # user_ip -> {file_id: size} and user_ip -> total size, kept in step
+        # with _files so quota checks and listings only touch one user's files.
+        self._owner_files = {}
+        self._owner_bytes = {}
+        for file_info in self._files.values():
+            self._index(file_info)
+
+    @timed(METADATA_SECONDS, 'load')
+    def _load(self):
+        if self.path.exists():
+            try:
+                with open(self.path, 'r') as f:
+                    return json.load(f)
+            except Exception as e:
+                logger.error(f'Metadata load error: {str(e)}')
+        return {}
+
+    @timed(METADATA_SECONDS, 'save')
+    def _save(self):
+        # Serialized from a copy, as entries may change while the write runs.
+        snapshot = {file_id: dict(file_info) for file_id, file_info in self._files.items()}
+        disk_pool.run(self._write, snapshot)
+
+    def _write(self, files):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(files, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def _index(self, file_info):
+        user_ip = file_info.get('user_ip')
+        size = file_info.get('size') or 0
+        self._owner_files.setdefault(user_ip, {})[file_info['file_id']] = size
+        self._owner_bytes[user_ip] = self._owner_bytes.get(user_ip, 0) + size
+
+    def _unindex(self, file_info):
+        user_ip = file_info.get('user_ip')
+        owned = self._owner_files.get(user_ip, {})
+        size = owned.pop(file_info['file_id'], 0)
+        if owned:
+            self._owner_bytes[user_ip] -= size
+        else:
+            self._owner_files.pop(user_ip, None)
+            self._owner_bytes.pop(user_ip, None)
+
+    def get(self, file_id):
+        file_info = self._files.get(file_id)
+        return dict(file_info) if file_info else None
+
+    def add(self, file_info):
+        with self._lock:
+            self._files[file_info['file_id']] = dict(file_info)
+            self._index(file_info)
+            self._save()
+
+    def update(self, file_id, **fields):
+        with self._lock:
+            file_info = self._files.get(file_id)
+            if file_info is None:
+                return False
+            self._unindex(file_info)
+            file_info.update(fields)
+            self._index(file_info)
+            self._save()
+            return True
+
+    def delete(self, file_id):
+        """Returns (found, sha256 of a blob that is no longer referenced)."""
+        with self._lock:
+            file_info = self._files.pop(file_id, None)
+            if file_info is None:
+                return False, None
+            self._unindex(file_info)
+            self._save()
+        sha256 = file_info.get('sha256')
+        if sha256 and not any(f.get('sha256') == sha256 for f in self._files.values()):
+            return True, sha256
+        return True, None
+
+    def rebuild_blob_refcounts(self):
+        # Reference counts are derived from the entries themselves.
+        pass
+
+    def rebuild_owner_index(self):
+        # Built from the entries on load.
+        pass
+
+    def list_by_user(self, user_ip):
+        return [dict(self._files[file_id]) for file_id in self._owner_files.get(user_ip, ())]
+
+    def usage_by_user(self, user_ip):
+        """(file count, total bytes) of user_ip's files."""
+        return len(self._owner_files.get(user_ip, ())), self._owner_bytes.get(user_ip, 0)
+
+class SqliteMetadataStore:
+    """Default backend: one row per file in a WAL-mode SQLite database, so every
+    read and write touches a single indexed row instead of the whole index."""
+
+    # Columns added after the first schema; created on older databases at startup.
+    ADDED_COLUMNS = {
+        'sha256': 'TEXT',
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                file_id TEXT PRIMARY KEY,
+                original_name TEXT NOT NULL,
+                current_name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                uploaded_at TEXT NOT NULL,
+                user_ip TEXT,
+                password_hash TEXT,
+                is_password_protected INTEGER NOT NULL DEFAULT 0,
+                sha256 TEXT
+            )
+        """)
+        existing = {row['name'] for row in self._conn.execute('PRAGMA table_info(files)')}
+        for column, column_type in self.ADDED_COLUMNS.items():
+            if column not in existing:
+                self._conn.execute(f'ALTER TABLE files ADD COLUMN {column} {column_type}')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_files_user_ip ON files (user_ip)')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                refcount INTEGER NOT NULL
+            )
+        """)
+        # Running file count and byte total per user_ip, updated in the same
+        # transaction as the files rows, so quota checks read a single row.
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS owners (
+                user_ip TEXT PRIMARY KEY,
+                file_count INTEGER NOT NULL,
+                total_bytes INTEGER NOT NULL
+            )
+        """)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    @staticmethod
+    def _add_usage(conn, user_ip, files, size):
+        if user_ip is None:
+            return
+        conn.execute(
+            'INSERT INTO owners (user_ip, file_count, total_bytes) VALUES (?, ?, ?) '
+            'ON CONFLICT (user_ip) DO UPDATE SET file_count = file_count + excluded.file_count, '
+            'total_bytes = total_bytes + excluded.total_bytes',
+            (user_ip, files, size or 0)
+        )
+        conn.execute('DELETE FROM owners WHERE user_ip = ? AND file_count <= 0', (user_ip,))
+
+    @staticmethod
+    def _row_to_info(row):
+        file_info = dict(row)
+        file_info['is_password_protected'] = bool(file_info['is_password_protected'])
+        return file_info
+
+    @timed(METADATA_SECONDS, 'load')
+    def get(self, file_id):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM files WHERE file_id = ?', (file_id,)).fetchone()
+        return self._row_to_info(row) if row else None
+
+    @timed(METADATA_SECONDS, 'save')
+    def add(self, file_info):
+        values = [file_info.get(field) for field in FILE_FIELDS]
+        with self._transaction() as conn:
+            conn.execute(
+                f'INSERT INTO files ({", ".join(FILE_FIELDS)}) VALUES ({", ".join("?" * len(FILE_FIELDS))})',
+                values
+            )
+            self._add_usage(conn, file_info.get('user_ip'), 1, file_info.get('size'))
+            if file_info.get('sha256'):
+                conn.execute(
+                    'INSERT INTO blobs (sha256, size, refcount) VALUES (?, ?, 1) '
+                    'ON CONFLICT (sha256) DO UPDATE SET refcount = refcount + 1',
+                    (file_info['sha256'], file_info['size'])
+                )
+
+    @timed(METADATA_SECONDS, 'save')
+    def update(self, file_id, **fields):
+        unknown = set(fields) - set(FILE_FIELDS)
+        if unknown:
+            raise ValueError(f'Unknown metadata fields: {", ".join(sorted(unknown))}')
+        if not fields:
+            return self.get(file_id) is not None
+        assignments = ', '.join(f'{field} = ?' for field in fields)
+        with self._transaction() as conn:
+            old = None
+            if 'user_ip' in fields or 'size' in fields:
+                old = conn.execute('SELECT user_ip, size FROM files WHERE file_id = ?', (file_id,)).fetchone()
+            cursor = conn.execute(
+                f'UPDATE files SET {assignments} WHERE file_id = ?',
+                [*fields.values(), file_id]
+            )
+            if old is not None:
+                self._add_usage(conn, old['user_ip'], -1, -old['size'])
+                self._add_usage(conn, fields.get('user_ip', old['user_ip']), 1, fields.get('size', old['size']))
+        return cursor.rowcount > 0
+
+    @timed(METADATA_SECONDS, 'save')
+    def delete(self, file_id):
+        """Returns (found, sha256 of a blob that is no longer referenced)."""
+        with self._transaction() as conn:
+            row = conn.execute('SELECT sha256, user_ip, size FROM files WHERE file_id = ?', (file_id,)).fetchone()
+            if row is None:
+                return False, None
+            conn.execute('DELETE FROM files WHERE file_id = ?', (file_id,))
+            self._add_usage(conn, row['user_ip'], -1, -row['size'])
+            sha256 = row['sha256']
+            if not sha256:
+                return True, None
+            conn.execute('UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?', (sha256,))
+            blob = conn.execute('SELECT refcount FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+            if blob is not None and blob['refcount'] > 0:
+                return True, None
+            conn.execute('DELETE FROM blobs WHERE sha256 = ?', (sha256,))
+            return True, sha256
+
+    def rebuild_blob_refcounts(self):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM blobs')
+            conn.execute(
+                'INSERT INTO blobs (sha256, size, refcount) '
+                'SELECT sha256, MAX(size), COUNT(*) FROM files WHERE sha256 IS NOT NULL GROUP BY sha256'
+            )
+
+    def rebuild_owner_index(self):
+        """Brings owners in line with files, e.g. for rows written before the
+        table existed or edited by hand. Only rows that disagree are written.
+        Returns the number of owners corrected."""
+        with self._transaction() as conn:
+            changes = conn.total_changes
+            conn.execute('DELETE FROM owners WHERE user_ip NOT IN (SELECT user_ip FROM files WHERE user_ip IS NOT NULL)')
+            conn.execute(
+                'INSERT INTO owners (user_ip, file_count, total_bytes) '
+                'SELECT user_ip, COUNT(*), SUM(size) FROM files WHERE user_ip IS NOT NULL GROUP BY user_ip '
+                'ON CONFLICT (user_ip) DO UPDATE SET file_count = excluded.file_count, total_bytes = excluded.total_bytes '
+                'WHERE file_count != excluded.file_count OR total_bytes != excluded.total_bytes'
+            )
+            return conn.total_changes - changes
+
+    @timed(METADATA_SECONDS, 'load')
+    def list_by_user(self, user_ip):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT * FROM files WHERE user_ip = ? ORDER BY uploaded_at', (user_ip,)
+            ).fetchall()
+        return [self._row_to_info(row) for row in rows]
+
+    @timed(METADATA_SECONDS, 'load')
+    def usage_by_user(self, user_ip):
+        """(file count, total bytes) of user_ip's files."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT file_count, total_bytes FROM owners WHERE user_ip = ?', (user_ip,)
+            ).fetchone()
+        return (row['file_count'], row['total_bytes']) if row else (0, 0)
+
+    def import_json(self, json_path):
+        """One-shot migration from the legacy metadata.json. The source file is
+        renamed afterwards so the import never runs twice."""
+        with open(json_path, 'r') as f:
+            legacy = json.load(f)
+
+        rows = []
+        for file_id, file_info in legacy.items():
+            file_info = {**file_info, 'file_id': file_id}
+            file_info.setdefault('current_name', file_info.get('original_name', file_id))
+            file_info.setdefault('original_name', file_info['current_name'])
+            file_info.setdefault('size', 0)
+            file_info.setdefault('uploaded_at', datetime.now(timezone.utc).isoformat())
+            file_info['is_password_protected'] = bool(file_info.get('is_password_protected'))
+            rows.append([file_info.get(field) for field in FILE_FIELDS])
+
+        with self._transaction() as conn:
+            conn.executemany(
+                f'INSERT OR IGNORE INTO files ({", ".join(FILE_FIELDS)}) VALUES ({", ".join("?" * len(FILE_FIELDS))})',
+                rows
+            )
+
+        self.rebuild_blob_refcounts()
+        json_path.rename(json_path.with_name(json_path.name + '.migrated'))
+        logger.info(f'Migrated {len(rows)} file records from {json_path} to {self.path}')
+
+def create_metadata_store():
+    if METADATA_BACKEND == 'json':
+        # Each process would hold its own copy and overwrite the others' writes.
+        if SOCKETIO_MESSAGE_QUEUE:
+            raise RuntimeError('METADATA_BACKEND=json cannot be shared by several workers; use sqlite')
+        return JsonMetadataStore(files_metadata_path)
+    if METADATA_BACKEND != 'sqlite':
+        raise ValueError(f'Unknown METADATA_BACKEND: {METADATA_BACKEND}')
+
+    store = SqliteMetadataStore(METADATA_DB_PATH)
+    with startup_lock():
+        if files_metadata_path.exists():
+            store.import_json(files_metadata_path)
+        corrected = store.rebuild_owner_index()
+    if corrected:
+        logger.info(f'Corrected {corrected} per-user file totals')
+    return store
+
+metadata_store = create_metadata_store()
+
+def quota_error(user_ip, size=0, session_id=None):
+    """The 403 response when one more file of size bytes would put user_ip
+    over MAX_FILES_PER_USER or MAX_BYTES_PER_USER, else None. Open upload
+    sessions count at their declared size, except session_id, the one being
+    finalized."""
+    count, total = metadata_store.usage_by_user(user_ip)
+    session_count, session_bytes = upload_session_usage(user_ip, exclude=session_id)
+    count += session_count
+    total += session_bytes
+    if count >= MAX_FILES_PER_USER:
+        return jsonify({'error': f'Maximum {MAX_FILES_PER_USER} files allowed per user'}), 403
+    if MAX_BYTES_PER_USER and total + size > MAX_BYTES_PER_USER:
+        return jsonify({'error': f'Storage quota exceeded. Maximum {MAX_BYTES_PER_USER // (1024 * 1024)} MB per user'}), 403
+    return None
+
+# --- BLOB STORE ---
+# Placing a blob and registering a reference to it (or dropping the last
+# reference and unlinking it) happen under blob_lock, so a concurrent delete can
+# never remove content an upload has just deduplicated against. Workers share
+# uploads/ and the refcounts, so the lock is also an flock on BLOB_LOCK_PATH.
+BLOB_LOCK_PATH = UPLOADS_DIR / '.blobs.lock'
+BLOB_LOCK_POLL = 0.005
+blob_thread_lock = threading.Lock()
+
+@contextmanager
+def blob_lock():
+    """Held by one greenlet in one worker at a time. Waits for other workers
+    by polling, so the hub keeps running meanwhile. Without fcntl (Windows)
+    it only locks within the process."""
+    with blob_thread_lock, open(BLOB_LOCK_PATH, 'a') as f:
+        if fcntl is not None:
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    eventlet.sleep(BLOB_LOCK_POLL)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def blob_path(sha256):
+    return BLOBS_DIR / sha256[:2] / sha256
+
+def store_blob(src_path, sha256):
+    """Moves src_path into the blob store, or drops it if the content is already
+    stored. Returns True when a new blob was written."""
+    dest_path = blob_path(sha256)
+    if dest_path.exists():
+        Path(src_path).unlink()
+        return False
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(src_path, dest_path)
+    return True
+
+def stored_file_path(file_info):
+    if file_info.get('sha256'):
+        return blob_path(file_info['sha256'])
+    return UPLOADS_DIR / file_info['file_id'] / file_info['current_name']
+
+def publish_upload(file_id, filename, src_path, size, sha256):
+    with blob_lock():
+        store_blob(src_path, sha256)
+        return create_file_record(file_id, filename, size, sha256)
+
+def publish_duplicate(file_id, filename, size, sha256, user_ip):
+    """Registers file_id against a blob user_ip already has a file of, without
+    any data being sent. The hash is only the client's word, so other users'
+    content is never matched: that would hand out files (including password
+    protected ones) to anyone knowing their hash, and reveal that they exist.
+    Returns None when user_ip has no file with that hash and size."""
+    with blob_lock():
+        owned = any(
+            f.get('sha256') == sha256 and f.get('size') == size
+            for f in metadata_store.list_by_user(user_ip)
+        )
+        if not owned or not blob_path(sha256).exists():
+            return None
+        return create_file_record(file_id, filename, size, sha256)
+
+def delete_file_record(file_id):
+    with blob_lock():
+        found, orphaned = metadata_store.delete(file_id)
+        if orphaned:
+            disk_pool.run(blob_path(orphaned).unlink, missing_ok=True)
+    return found
+
+def migrate_legacy_uploads():
+    """Moves files from the old UPLOADS_DIR/<file_id>/<name> layout into the blob
+    store. The metadata row is pointed at the blob before the file is moved, so
+    an interrupted run is simply repeated on the next start."""
+    migrated = 0
+    for file_dir in UPLOADS_DIR.iterdir():
+        if not file_dir.is_dir() or not FILE_ID_PATTERN.fullmatch(file_dir.name):
+            continue
+        if (file_dir / UPLOAD_SESSION_FILE).exists():
+            continue
+        file_info = metadata_store.get(file_dir.name)
+        if file_info is None:
+            continue
+        legacy_path = file_dir / file_info['current_name']
+        if legacy_path.exists():
+            sha256 = hash_file(legacy_path)
+            metadata_store.update(file_info['file_id'], sha256=sha256, size=legacy_path.stat().st_size)
+            store_blob(legacy_path, sha256)
+            migrated += 1
+        shutil.rmtree(file_dir, ignore_errors=True)
+
+    if migrated:
+        metadata_store.rebuild_blob_refcounts()
+        logger.info(f'Moved {migrated} uploads into the blob store')
+
+for stale_path in BLOBS_TMP_DIR.iterdir():
+    if is_stale(stale_path):
+        stale_path.unlink(missing_ok=True)
+
+# --- FILE DELIVERY ---
+# Downloads carry strong validators and honour RFC 7233 byte ranges, including
+# multi-range requests that werkzeug's send_file answers with 416.
+CACHE_CONTROL_PUBLIC_FILES = os.getenv('CACHE_CONTROL_PUBLIC_FILES', 'public, max-age=300')
+CACHE_CONTROL_PROTECTED_FILES = os.getenv('CACHE_CONTROL_PROTECTED_FILES', 'private, no-store')
+MAX_BYTE_RANGES = 16
+
+# How file bytes reach the client:
+#   stream     - Python reads the file and the WSGI server writes it (default)
+#   sendfile   - os.sendfile() from the file straight onto the client socket
+#   x-accel    - empty response with X-Accel-Redirect for a fronting nginx
+#   x-sendfile - empty response with X-Sendfile for Apache/lighttpd
+DOWNLOAD_MODES = ('stream', 'sendfile', 'x-accel', 'x-sendfile')
+DOWNLOAD_MODE = os.getenv('DOWNLOAD_MODE', 'stream').lower()
+X_ACCEL_PREFIX = os.getenv('X_ACCEL_PREFIX', '/_protected').rstrip('/')
+SENDFILE_CHUNK_SIZE = 1024 * 1024
+SENDFILE_ENVIRON_KEY = 'oxcy.sendfile'
+
+if DOWNLOAD_MODE not in DOWNLOAD_MODES:
+    raise ValueError(f'Unknown DOWNLOAD_MODE: {DOWNLOAD_MODE}')
+if DOWNLOAD_MODE == 'sendfile' and not hasattr(os, 'sendfile'):
+    logger.warning('os.sendfile is not available on this platform, using DOWNLOAD_MODE=stream')
+    DOWNLOAD_MODE = 'stream'
+
+def client_socket(environ):
+    if 'eventlet.input' in environ:
+        return environ['eventlet.input'].get_socket()
+    return environ.get('gunicorn.socket')
+
+def request_sendfile(path, offset, count):
+    """Flags the current response for SendfileMiddleware when the client socket
+    can take os.sendfile (plain TCP only; TLS needs the userspace path)."""
+    slot = request.environ.get(SENDFILE_ENVIRON_KEY)
+    if slot is None or request.method != 'GET' or count <= 0:
+        return
+    sock = client_socket(request.environ)
+    if sock is None or isinstance(sock, ssl.SSLSocket):
+        return
+    slot.append((str(path), offset, count))
+
+class SendfileMiddleware:
+    """Writes responses flagged by request_sendfile itself: the status line and
+    headers Flask produced, then the file range via os.sendfile. The connection
+    is closed afterwards because the WSGI server no longer tracks it."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        # Flask-SocketIO hands the Flask app a copy of environ, so the view
+        # reports back through this shared list rather than a new key.
+        slot = environ[SENDFILE_ENVIRON_KEY] = []
+        taken_over = []
+
+        def sendfile_start_response(status, headers, exc_info=None):
+            if slot and exc_info is None:
+                taken_over[:] = [status, headers]
+                return lambda data: None
+            return start_response(status, headers, exc_info)
+
+        body = self.wsgi_app(environ, sendfile_start_response)
+        if not taken_over:
+            return body
+
+        if hasattr(body, 'close'):
+            body.close()
+
+        status, headers = taken_over
+        path, offset, count = slot[0]
+        sock = client_socket(environ)
+        head = [f'HTTP/1.1 {status}']
+        head.extend(f'{name}: {value}' for name, value in headers if name.lower() != 'connection')
+        head.append('Connection: close')
         try:
-            with open(files_metadata_path, 'r') as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
+            sock.sendall(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+            self._sendfile(sock, path, offset, count)
+        except OSError as e:
+            logger.info(f'Sendfile aborted: {str(e)}')
+
+        eventlet_wsgi.WSGI_LOCAL.already_handled = True
+        return []
+
+    @staticmethod
+    def _sendfile(sock, path, offset, count):
+        with open(path, 'rb') as f:
+            while count > 0:
+                try:
+                    sent = os.sendfile(sock.fileno(), f.fileno(), offset, min(count, SENDFILE_CHUNK_SIZE))
+                except BlockingIOError:
+                    trampoline(sock, write=True)
+                    continue
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+                # Let chat and other requests run between chunks on fast links.
+                eventlet.sleep(0)
+
+if DOWNLOAD_MODE == 'sendfile':
+    app.wsgi_app = SendfileMiddleware(app.wsgi_app)
+
+def parse_byte_ranges(range_header, size):
+    """Returns the requested (start, stop) spans sorted and coalesced, [] when
+    none of them is satisfiable, or None when the header should be ignored."""
+    units, _, spec = range_header.partition('=')
+    if units.strip().lower() != 'bytes' or not spec.strip():
+        return None
+
+    spans = []
+    for item in spec.split(','):
+        first, dash, last = item.strip().partition('-')
+        first, last = first.strip(), last.strip()
+        if not dash or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            if not last:
+                return None
+            length = int(last)
+            if length > 0 and size > 0:
+                spans.append((max(size - length, 0), size))
+            continue
+        start = int(first)
+        stop = int(last) + 1 if last else size
+        if last and stop <= start:
+            return None
+        if start < size:
+            spans.append((start, min(stop, size)))
+
+    if len(spans) > MAX_BYTE_RANGES:
+        return None
+
+    merged = []
+    for start, stop in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def if_range_matches(etag, last_modified):
+    if 'If-Range' not in request.headers:
+        return True
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None and last_modified is not None:
+        return if_range.date == last_modified.replace(microsecond=0)
+    return False
+
+def iter_file_spans(path, spans, separators=None, closing=b''):
+    with open(path, 'rb') as f:
+        for index, (start, stop) in enumerate(spans):
+            if separators:
+                yield separators[index]
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+            if separators:
+                yield b'\r\n'
+        if closing:
+            yield closing
+
+def record_download(response, size=None):
+    """Counts the body bytes of a file response, or size when the fronting
+    server sends the body. HEAD responses have none."""
+    if request.method != 'HEAD':
+        DOWNLOAD_BYTES.add(response.content_length if size is None else size, DOWNLOAD_MODE)
+    return response
+
+def handed_off_size(size, etag, last_modified):
+    """File bytes an x-accel/x-sendfile server will send for this request,
+    which is the requested ranges when it honours Range."""
+    range_header = request.headers.get('Range')
+    if request.method == 'GET' and range_header and if_range_matches(etag, last_modified):
+        spans = parse_byte_ranges(range_header, size)
+        if spans is not None:
+            return sum(stop - start for start, stop in spans)
+    return size
+
+def send_stored_file(path, download_name, etag=None, last_modified=None,
+                     cache_control=CACHE_CONTROL_PUBLIC_FILES):
+    """Sends path as an attachment with ETag/Last-Modified validators, answering
+    If-None-Match/If-Modified-Since with 304 and Range with 206 (a
+    multipart/byteranges body when several ranges are requested)."""
+    stat = os.stat(path)
+    size = stat.st_size
+    if etag is None:
+        etag = f'{stat.st_mtime_ns:x}-{size:x}'
+    if last_modified is None:
+        last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+
+    def make_response(body, status, content_type=mimetype):
+        response = Response(body, status=status, content_type=content_type, direct_passthrough=True)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = cache_control
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+        return response
+
+    if request.method in ('GET', 'HEAD'):
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = make_response(None, 304)
+            response.headers.pop('Content-Type', None)
+            return response
+
+    # The fronting server reads the file and handles Range itself.
+    if DOWNLOAD_MODE == 'x-accel':
+        response = make_response(None, 200)
+        relative_path = Path(path).resolve().relative_to(Path.cwd().resolve())
+        response.headers['X-Accel-Redirect'] = f'{X_ACCEL_PREFIX}/{quote(relative_path.as_posix())}'
+        return record_download(response, handed_off_size(size, etag, last_modified))
+    if DOWNLOAD_MODE == 'x-sendfile':
+        response = make_response(None, 200)
+        response.headers['X-Sendfile'] = str(Path(path).resolve())
+        return record_download(response, handed_off_size(size, etag, last_modified))
+
+    if request.method in ('GET', 'HEAD'):
+        range_header = request.headers.get('Range')
+        spans = None
+        if range_header and if_range_matches(etag, last_modified):
+            spans = parse_byte_ranges(range_header, size)
+
+        if spans == []:
+            response = make_response(None, 416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+
+        if spans and len(spans) == 1:
+            start, stop = spans[0]
+            response = make_response(iter_file_spans(path, spans), 206)
+            response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+            response.content_length = stop - start
+            request_sendfile(path, start, stop - start)
+            return record_download(response)
+
+        if spans:
+            boundary = uuid.uuid4().hex
+            separators = [
+                (f'--{boundary}\r\nContent-Type: {mimetype}\r\n'
+                 f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode()
+                for start, stop in spans
+            ]
+            closing = f'--{boundary}--\r\n'.encode()
+            response = make_response(
+                iter_file_spans(path, spans, separators, closing), 206,
+                f'multipart/byteranges; boundary={boundary}'
+            )
+            response.content_length = (
+                sum(len(sep) + (stop - start) + 2 for sep, (start, stop) in zip(separators, spans))
+                + len(closing)
+            )
+            return record_download(response)
+
+    response = make_response(wrap_file(request.environ, open(path, 'rb')), 200)
+    response.content_length = size
+    request_sendfile(path, 0, size)
+    return record_download(response)
 
-def save_files_metadata(metadata):
-    with open(files_metadata_path, 'w') as f:
-        json.dump(metadata, f, indent=2)
+def upload_validators(file_info):
+    """Strong ETag and Last-Modified for an uploaded file. The ETag covers the
+    content hash and the download name, since a rename changes the
+    Content-Disposition of the response. It is an HMAC, so it does not give
+    away the hash or which files share content."""
+    etag = None
+    if file_info.get('sha256'):
+        message = f"{file_info['file_id']}:{file_info['sha256']}:{file_info['current_name']}"
+        etag = hmac.new(app.config['SECRET_KEY'].encode(), message.encode(), hashlib.sha256).hexdigest()[:32]
+    try:
+        last_modified = datetime.fromisoformat(file_info['uploaded_at'])
+    except (KeyError, TypeError, ValueError):
+        last_modified = None
+    return etag, last_modified
+
+# --- DOWNLOAD TOKENS ---
+# A correct password buys a short-lived HMAC token for that file, so repeat and
+# ranged downloads skip the deliberately slow password hash. The signature also
+# covers the stored password hash, so changing the password revokes old tokens.
+DOWNLOAD_TOKEN_TTL = int(os.getenv('DOWNLOAD_TOKEN_TTL', 900))
+DOWNLOAD_TOKEN_COOKIE = 'download_token'
+
+def download_token_signature(file_info, expires):
+    message = f"{file_info['file_id']}:{expires}:{file_info.get('password_hash') or ''}"
+    digest = hmac.new(app.config['SECRET_KEY'].encode(), message.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def mint_download_token(file_info):
+    expires = int(time.time()) + DOWNLOAD_TOKEN_TTL
+    return f'{expires}.{download_token_signature(file_info, expires)}'
+
+def verify_download_token(file_info, token):
+    expires, _, signature = (token or '').partition('.')
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, download_token_signature(file_info, int(expires)))
+
+# --- RATE LIMITING ---
+def parse_rate_limit(value):
+    """'20/60' is a burst of 20 refilled over 60 seconds. Empty or 0 means
+    no limit."""
+    count, _, seconds = (value or '').partition('/')
+    if not count or int(count) <= 0:
+        return None
+    return int(count), float(seconds or 1)
+
+RATE_LIMITS = {
+    'join': {
+        'sid': parse_rate_limit(os.getenv('RATE_LIMIT_JOIN_PER_SID', '5/10')),
+        'ip': parse_rate_limit(os.getenv('RATE_LIMIT_JOIN_PER_IP', '30/60'))
+    },
+    'send_message': {
+        'sid': parse_rate_limit(os.getenv('RATE_LIMIT_MESSAGE_PER_SID', '10/5')),
+        'ip': parse_rate_limit(os.getenv('RATE_LIMIT_MESSAGE_PER_IP', '60/10'))
+    },
+    'upload': {
+        'ip': parse_rate_limit(os.getenv('RATE_LIMIT_UPLOAD_PER_IP', '20/60'))
+    },
+    'ai_chat': {
+        'ip': parse_rate_limit(os.getenv('RATE_LIMIT_AI_PER_IP', '10/60'))
+    }
+}
+RATE_LIMIT_SWEEP_INTERVAL = 60
+
+class TokenBucketLimiter:
+    """In-memory token buckets keyed by (route, scope, key), e.g.
+    ('send_message', 'sid', sid). A check refills one bucket per scope from
+    the elapsed time and takes a token from each only if all of them have
+    one, so it is O(1) and touches no disk or network."""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}
+        self.counters = {route: {'allowed': 0, 'rejected': 0} for route in limits}
+
+    def check(self, route, **keys):
+        """Take a token for route. Returns 0 if allowed, else the seconds
+        until a token will be available."""
+        now = time.monotonic()
+        updates = []
+        retry_after = 0
+        for scope, key in keys.items():
+            limit = self.limits[route].get(scope)
+            if limit is None:
+                continue
+            burst, period = limit
+            bucket_key = (route, scope, key)
+            tokens, stamp = self.buckets.get(bucket_key, (burst, now))
+            tokens = min(burst, tokens + (now - stamp) * burst / period)
+            if tokens < 1:
+                retry_after = max(retry_after, (1 - tokens) * period / burst)
+            updates.append((bucket_key, tokens))
+
+        if retry_after:
+            self.counters[route]['rejected'] += 1
+            for bucket_key, tokens in updates:
+                self.buckets[bucket_key] = (tokens, now)
+            return retry_after
+        self.counters[route]['allowed'] += 1
+        for bucket_key, tokens in updates:
+            self.buckets[bucket_key] = (tokens - 1, now)
+        return 0
+
+    def sweep(self):
+        """Drop buckets that have refilled completely; they are the same as
+        no bucket at all."""
+        now = time.monotonic()
+        for bucket_key, (tokens, stamp) in list(self.buckets.items()):
+            route, scope, _ = bucket_key
+            burst, period = self.limits[route][scope]
+            if tokens + (now - stamp) * burst / period >= burst:
+                del self.buckets[bucket_key]
+
+    def sweep_forever(self, interval):
+        while True:
+            eventlet.sleep(interval)
+            self.sweep()
+
+    def stats(self):
+        return {
+            'buckets': len(self.buckets),
+            'routes': {route: dict(counts) for route, counts in self.counters.items()}
+        }
+
+rate_limiter = TokenBucketLimiter(RATE_LIMITS)
+Counter('rate_limit_checks_total', 'Rate limit checks by route and result.', ('route', 'result'), collect=lambda: {
+    (route, result): count
+    for route, counts in rate_limiter.counters.items()
+    for result, count in counts.items()
+})
+Gauge('rate_limit_buckets', 'Token buckets held in memory.', collect=lambda: {(): len(rate_limiter.buckets)})
+socketio.start_background_task(rate_limiter.sweep_forever, RATE_LIMIT_SWEEP_INTERVAL)
+
+def rate_limited_response(route):
+    """A 429 response if the client IP is over its limit for route, else None."""
+    retry_after = rate_limiter.check(route, ip=request.remote_addr)
+    if not retry_after:
+        return None
+    response = jsonify({'error': 'Too many requests', 'retry_after': round(retry_after, 1)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response
+
+def socket_rate_limited(route):
+    """Checks the sender's sid and IP for a socket event. Emits chat_error
+    and returns True when the event should be dropped."""
+    retry_after = rate_limiter.check(route, sid=request.sid, ip=request.remote_addr)
+    if retry_after:
+        emit('chat_error', {'event': route, 'error': 'Too many requests', 'retry_after': round(retry_after, 1)})
+    return bool(retry_after)
 
 # --- CHAT STATE ---
 users = {}
-messages_history = []
-MAX_HISTORY = 50
+MAX_HISTORY = int(os.getenv('CHAT_HISTORY_SIZE', 50))
+JOIN_HISTORY = 30
+FETCH_HISTORY_LIMIT = 50
+DEFAULT_ROOM = 'global'
+ROOM_NAME_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,32}')
+MAX_ROOMS = int(os.getenv('MAX_ROOMS', 100))
+PRESENCE_BATCH_MS = int(os.getenv('PRESENCE_BATCH_MS', 100))
+# 0 sends every chat message as its own new_message. Otherwise clients that
+# join with batch: true get new_messages arrays, flushed after this many ms
+# or MESSAGE_BATCH_MAX messages, and the rest keep getting new_message.
+MESSAGE_BATCH_MS = int(os.getenv('MESSAGE_BATCH_MS', 0))
+MESSAGE_BATCH_MAX = int(os.getenv('MESSAGE_BATCH_MAX', 50))
+
+# With several workers behind sticky sessions, presence and history are kept
+# in a shared Redis-compatible store. Defaults to the Socket.IO message queue.
+CHAT_STORE_URL = os.getenv('CHAT_STORE_URL') or (
+    SOCKETIO_MESSAGE_QUEUE if (SOCKETIO_MESSAGE_QUEUE or '').startswith(('redis://', 'rediss://', 'unix://')) else ''
+)
+CHAT_STORE_PREFIX = os.getenv('CHAT_STORE_PREFIX', 'oxcy:chat:')
+CHAT_PRESENCE_TTL = int(os.getenv('CHAT_PRESENCE_TTL', 30))
+WORKER_ID = uuid.uuid4().hex[:12]
+
+if CHAT_STORE_URL and redis is None:
+    raise RuntimeError('CHAT_STORE_URL needs the redis package (pip install redis)')
+chat_store = redis.Redis.from_url(CHAT_STORE_URL, decode_responses=True) if CHAT_STORE_URL else None
+
+class MessageRing:
+    """Fixed-capacity chat history. Every message gets a monotonically
+    increasing id and lives in slot id % capacity, so appending and reading
+    the tail cost the same no matter how long the server has been up."""
 
-def serialize_message(user, content):
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+        self.reset(1)
+
+    def reset(self, next_id):
+        self._slots = [None] * self.capacity
+        self.first_id = self.next_id = next_id
+
+    def append(self, msg):
+        msg['id'] = self.next_id
+        self._slots[self.next_id % self.capacity] = msg
+        self.next_id += 1
+        if self.next_id - self.first_id > self.capacity:
+            self.first_id += 1
+        return msg
+
+    def before(self, before_id, limit):
+        stop = max(self.first_id, min(before_id, self.next_id))
+        start = max(self.first_id, stop - limit)
+        return [self._slots[i % self.capacity] for i in range(start, stop)]
+
+    def tail(self, limit):
+        return self.before(self.next_id, limit)
+
+def serialize_message(user, content, room=DEFAULT_ROOM):
     return {
         'user': user, 
         'content': content, 
+        'room': room,
         'timestamp': datetime.now(timezone.utc).isoformat()
     }
 
-# --- FILE UPLOAD ROUTES ---
-@app.route('/api/files/upload', methods=['POST'])
-def upload_file():
-    try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        filename = secure_filename(file.filename)
-        ext = Path(filename).suffix.lower()
-        
-        if ext not in ALLOWED_EXTENSIONS:
-            return jsonify({'error': f'File type not allowed. Allowed: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
-        
-        if len(file.read()) > MAX_FILE_SIZE:
-            file.seek(0)
-            return jsonify({'error': 'File too large. Maximum size: 12 MB'}), 400
-        
-        file.seek(0)
-        
-        metadata = load_files_metadata()
-        user_files = [f for f in metadata.values() if f.get('user_ip') == request.remote_addr]
-        
-        if len(user_files) >= MAX_FILES_PER_USER:
-            return jsonify({'error': f'Maximum {MAX_FILES_PER_USER} files allowed per user'}), 403
-        
-        file_id = str(uuid.uuid4())[:8]
-        
-        file_path = UPLOADS_DIR / file_id / filename
-        file_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        file.save(str(file_path))
-        
-        file_info = {
-            'file_id': file_id,
-            'original_name': filename,
-            'current_name': filename,
-            'size': os.path.getsize(str(file_path)),
-            'uploaded_at': datetime.now(timezone.utc).isoformat(),
-            'user_ip': request.remote_addr,
-            'password_hash': None,
-            'is_password_protected': False
-        }
-        
-        metadata[file_id] = file_info
-        save_files_metadata(metadata)
-        
-        download_link = f"{TUNNEL_URL}/api/files/download/{file_id}"
-        
-        logger.info(f'File uploaded: {file_id} by {request.remote_addr}')
-        
-        return jsonify({
-            'success': True,
+# --- CHAT LOG ---
+CHAT_LOG_DIR = os.getenv('CHAT_LOG_DIR', 'chat_log')
+CHAT_LOG_SEGMENT_MESSAGES = int(os.getenv('CHAT_LOG_SEGMENT_MESSAGES', 10000))
+CHAT_LOG_MAX_SEGMENTS = int(os.getenv('CHAT_LOG_MAX_SEGMENTS', 0))
+CHAT_LOG_FSYNC_MS = int(os.getenv('CHAT_LOG_FSYNC_MS', 200))
+CHAT_LOG_INDEX_ENTRY = struct.Struct('>Q')
+
+# Separate processes appending to one log would hand out the same ids.
+if SOCKETIO_MESSAGE_QUEUE and not chat_store and CHAT_LOG_DIR:
+    raise RuntimeError(
+        'Several workers need a shared chat store: set CHAT_STORE_URL to a Redis URL, '
+        'or CHAT_LOG_DIR= to keep each worker\'s history in memory only'
+    )
+# Room logs kept on disk; the least recently opened ones of unloaded rooms
+# are deleted past this. Never below MAX_ROOMS.
+CHAT_LOG_MAX_ROOMS = int(os.getenv('CHAT_LOG_MAX_ROOMS', 1000))
+CHAT_LOG_TRASH_PREFIX = '.deleted-'
+
+# Room names with a log on disk, least recently opened first.
+chat_log_rooms = OrderedDict()
+
+class ChatLog:
+    """Append-only chat log split into segments of CHAT_LOG_SEGMENT_MESSAGES.
+    <first_id>.log holds one JSON message per line and <first_id>.idx the
+    fixed-width byte offset of each of them, so any message id is found with
+    one index read and one seek. Writes go straight to the files; fsync is
+    batched by sync(), which runs without the lock, so files rotated or
+    closed meanwhile are only closed once no fsync is using them."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(
+            int(name[:-4]) for name in os.listdir(directory)
+            if name.endswith('.log') and name[:-4].isdigit()
+        )
+        self._log_fd = self._idx_fd = None
+        self._dirty = False
+        self._syncing = 0
+        self._retired = []
+        self.next_id = 1
+        if self.segments:
+            self._open_segment(self.segments[-1])
+            self._recover()
+
+    @property
+    def first_id(self):
+        return self.segments[0] if self.segments else self.next_id
+
+    def _segment_path(self, first_id, ext):
+        return os.path.join(self.directory, f'{first_id:020d}{ext}')
+
+    def _open_segment(self, first_id):
+        flags = os.O_RDWR | os.O_CREAT | os.O_APPEND
+        self._log_fd = os.open(self._segment_path(first_id, '.log'), flags, 0o644)
+        self._idx_fd = os.open(self._segment_path(first_id, '.idx'), flags, 0o644)
+        self._segment_first = first_id
+        self._segment_count = 0
+        self._log_size = 0
+        self.next_id = first_id
+
+    def _recover(self):
+        """Drop a torn last write and re-index messages the index missed."""
+        entry = CHAT_LOG_INDEX_ENTRY.size
+        log_size = os.fstat(self._log_fd).st_size
+        count = os.fstat(self._idx_fd).st_size // entry
+        while count:
+            offset, = CHAT_LOG_INDEX_ENTRY.unpack(os.pread(self._idx_fd, entry, (count - 1) * entry))
+            if offset < log_size:
+                break
+            count -= 1
+
+        # Re-read from the last indexed message, which may itself be torn.
+        count = max(count - 1, 0)
+        position = 0
+        if count:
+            position, = CHAT_LOG_INDEX_ENTRY.unpack(os.pread(self._idx_fd, entry, count * entry))
+        offsets = []
+        for line in os.pread(self._log_fd, log_size - position, position).split(b'\n')[:-1]:
+            try:
+                json.loads(line)
+            except ValueError:
+                break
+            offsets.append(position)
+            position += len(line) + 1
+
+        os.ftruncate(self._log_fd, position)
+        os.ftruncate(self._idx_fd, count * entry)
+        if offsets:
+            os.write(self._idx_fd, b''.join(CHAT_LOG_INDEX_ENTRY.pack(o) for o in offsets))
+        self._segment_count = count + len(offsets)
+        self._log_size = position
+        self.next_id = self._segment_first + self._segment_count
+
+    def _retire(self, *fds):
+        self._retired.extend(fds)
+        if not self._syncing:
+            retired, self._retired = self._retired, []
+            for fd in retired:
+                os.close(fd)
+
+    def _rotate(self):
+        if self._log_fd is not None:
+            os.fsync(self._log_fd)
+            os.fsync(self._idx_fd)
+            self._retire(self._log_fd, self._idx_fd)
+        self.segments.append(self.next_id)
+        self._open_segment(self.next_id)
+
+        while CHAT_LOG_MAX_SEGMENTS > 0 and len(self.segments) > CHAT_LOG_MAX_SEGMENTS:
+            oldest = self.segments.pop(0)
+            for ext in ('.log', '.idx'):
+                try:
+                    os.remove(self._segment_path(oldest, ext))
+                except FileNotFoundError:
+                    pass
+
+    def append(self, msg):
+        """Writes msg under the log's next id, which is stored in msg['id']."""
+        with self.lock:
+            msg['id'] = self.next_id
+            line = json.dumps(msg, separators=(',', ':')).encode() + b'\n'
+            if self._log_fd is None or self._segment_count >= CHAT_LOG_SEGMENT_MESSAGES:
+                self._rotate()
+            os.write(self._log_fd, line)
+            os.write(self._idx_fd, CHAT_LOG_INDEX_ENTRY.pack(self._log_size))
+            self._log_size += len(line)
+            self._segment_count += 1
+            self.next_id += 1
+            self._dirty = True
+
+    def sync(self):
+        with self.lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            self._syncing += 1
+            log_fd, idx_fd = self._log_fd, self._idx_fd
+        # Appends carry on during the fsync; only the fds are taken above.
+        try:
+            chat_log_pool.run(lambda: (os.fsync(log_fd), os.fsync(idx_fd)))
+        finally:
+            with self.lock:
+                self._syncing -= 1
+                self._retire()
+
+    def close(self):
+        with self.lock:
+            if self._log_fd is None:
+                return
+            os.fsync(self._log_fd)
+            os.fsync(self._idx_fd)
+            self._retire(self._log_fd, self._idx_fd)
+            self._log_fd = self._idx_fd = None
+            self._dirty = False
+
+    def _read_segment(self, first_id, index, count):
+        entry = CHAT_LOG_INDEX_ENTRY.size
+        with open(self._segment_path(first_id, '.idx'), 'rb') as f:
+            f.seek(index * entry)
+            start, = CHAT_LOG_INDEX_ENTRY.unpack(f.read(entry))
+        with open(self._segment_path(first_id, '.log'), 'rb') as f:
+            f.seek(start)
+            lines = []
+            while len(lines) < count:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break
+                lines.append(json.loads(line))
+        return lines
+
+    def read(self, start_id, stop_id):
+        """Messages with start_id <= id < stop_id, oldest first. Runs without
+        the lock, so segments pruned meanwhile are left out."""
+        segments = self.segments[:]
+        start_id = max(start_id, self.first_id)
+        stop_id = min(stop_id, self.next_id)
+        messages = []
+        while start_id < stop_id:
+            position = bisect.bisect_right(segments, start_id) - 1
+            segment_first = segments[position]
+            segment_stop = segments[position + 1] if position + 1 < len(segments) else stop_id
+            end_id = min(stop_id, segment_stop)
+            try:
+                messages.extend(self._read_segment(segment_first, start_id - segment_first, end_id - start_id))
+            except FileNotFoundError:
+                # Pruned by CHAT_LOG_MAX_SEGMENTS since segments was copied.
+                pass
+            start_id = end_id
+        return messages
+
+def scan_room_logs():
+    """Fills chat_log_rooms from CHAT_LOG_DIR, oldest first by the time each
+    log was last opened, and clears out deletions a restart interrupted."""
+    if not os.path.isdir(CHAT_LOG_DIR):
+        return
+    found = []
+    for entry in os.scandir(CHAT_LOG_DIR):
+        if entry.name.startswith(CHAT_LOG_TRASH_PREFIX):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        elif entry.is_dir() and ROOM_NAME_PATTERN.fullmatch(entry.name):
+            found.append((entry.stat().st_mtime, entry.name))
+    for _, name in sorted(found):
+        chat_log_rooms[name] = True
+
+def open_room_log(name):
+    """The ChatLog of room name. Giving a new room a log past
+    CHAT_LOG_MAX_ROOMS first deletes the logs of the least recently opened
+    rooms that are not loaded."""
+    if name not in chat_log_rooms:
+        limit = max(CHAT_LOG_MAX_ROOMS, MAX_ROOMS)
+        for old_name in list(chat_log_rooms):
+            if len(chat_log_rooms) < limit:
+                break
+            if old_name in rooms:
+                continue
+            del chat_log_rooms[old_name]
+            # Renamed first, so a join of that room during the delete starts
+            # a fresh log instead of opening a half-deleted one.
+            trash = os.path.join(CHAT_LOG_DIR, f'{CHAT_LOG_TRASH_PREFIX}{uuid.uuid4().hex}')
+            try:
+                os.rename(os.path.join(CHAT_LOG_DIR, old_name), trash)
+            except FileNotFoundError:
+                # Already gone: removed by hand or by another worker.
+                continue
+            socketio.start_background_task(disk_pool.run, shutil.rmtree, trash, ignore_errors=True)
+            logger.info(f'Deleted chat log of room {old_name}')
+    chat_log_rooms[name] = True
+    chat_log_rooms.move_to_end(name)
+    directory = os.path.join(CHAT_LOG_DIR, name)
+    log = ChatLog(directory)
+    os.utime(directory)
+    return log
+
+if CHAT_LOG_DIR:
+    scan_room_logs()
+
+# --- CHAT ROOMS ---
+class ChatRoom:
+    """A chat room: its members, recent history in memory and, when
+    CHAT_LOG_DIR is set, its own chat log."""
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}
+        self.presence_version = 0
+        self.pending_presence = []
+        self.pending_messages = []
+        self.history = MessageRing(MAX_HISTORY)
+        self.log = open_room_log(name) if CHAT_LOG_DIR else None
+        if self.log:
+            self.history.reset(max(self.log.first_id, self.log.next_id - self.history.capacity))
+            for msg in self.log.read(self.history.next_id, self.log.next_id):
+                self.history.append(msg)
+
+    def add_member(self, sid, username):
+        """Add a member and return the new presence version."""
+        self.members[sid] = username
+        self.presence_version += 1
+        return self.presence_version
+
+    def remove_member(self, sid):
+        """Remove a member and return (username, new presence version)."""
+        username = self.members.pop(sid)
+        self.presence_version += 1
+        return username, self.presence_version
+
+    def presence_snapshot(self):
+        return list(self.members.values()), self.presence_version
+
+    def queue_presence(self, change, message):
+        """Send a presence change with the next batch for this room. Changes
+        from a connection storm go out as one presence_update per
+        PRESENCE_BATCH_MS instead of one event per join or leave."""
+        self.pending_presence.append((change, message))
+        if PRESENCE_BATCH_MS <= 0:
+            self.flush_presence()
+        elif len(self.pending_presence) == 1:
+            socketio.start_background_task(self._flush_presence_later)
+
+    def _flush_presence_later(self):
+        eventlet.sleep(PRESENCE_BATCH_MS / 1000)
+        self.flush_presence()
+
+    def flush_presence(self):
+        pending, self.pending_presence = self.pending_presence, []
+        if pending:
+            emit_presence(self.name, pending, self.presence_snapshot()[0])
+
+    def broadcast(self, msg):
+        if MESSAGE_BATCH_MS <= 0:
+            socketio.emit('new_message', msg, to=self.name)
+            return
+        socketio.emit('new_message', msg, to=f'{self.name}:single')
+        self.pending_messages.append(msg)
+        if len(self.pending_messages) >= MESSAGE_BATCH_MAX:
+            self.flush_messages()
+        elif len(self.pending_messages) == 1:
+            socketio.start_background_task(self._flush_messages_later)
+
+    def _flush_messages_later(self):
+        eventlet.sleep(MESSAGE_BATCH_MS / 1000)
+        self.flush_messages()
+
+    def flush_messages(self):
+        pending, self.pending_messages = self.pending_messages, []
+        if pending:
+            socketio.emit('new_messages', {'room': self.name, 'messages': pending}, to=f'{self.name}:batch')
+
+    def record(self, msg):
+        """Add a message to the history, writing it to the chat log first so
+        a failed write does not leave a gap in the ids."""
+        if self.log:
+            # The log picks the id under its lock, so messages recorded
+            # while another append holds it never read the same next id.
+            self.log.append(msg)
+            if CHAT_LOG_FSYNC_MS <= 0:
+                self.log.sync()
+        return self.history.append(msg)
+
+    def history_before(self, before_id, limit):
+        """Up to limit messages older than before_id from memory, falling back
+        to the chat log for ids the ring buffer no longer holds."""
+        history, log = self.history, self.log
+        before_id = min(before_id or history.next_id, history.next_id)
+        if log and history.first_id > log.first_id and before_id - limit < history.first_id:
+            page = chat_log_pool.run(log.read, before_id - limit, before_id)
+            return page, bool(page) and page[0]['id'] > log.first_id
+        page = history.before(before_id, limit)
+        return page, bool(page) and page[0]['id'] > history.first_id
+
+    def tail(self, limit):
+        return self.history.tail(limit)
+
+    def close(self):
+        if self.log:
+            self.log.close()
+
+class SharedChatRoom(ChatRoom):
+    """A chat room whose member list and history live in the shared chat
+    store, so every worker sees the same room. self.members only holds the
+    sids connected to this worker. Member fields are prefixed with the
+    worker id so a dead worker's members can be swept."""
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}
+        self.pending_presence = []
+        self.pending_messages = []
+        self.log = None
+        self._key = f'{CHAT_STORE_PREFIX}room:{name}'
+
+    def add_member(self, sid, username):
+        self.members[sid] = username
+        pipe = chat_store.pipeline()
+        pipe.sadd(f'{CHAT_STORE_PREFIX}rooms', self.name)
+        pipe.hset(f'{self._key}:members', f'{WORKER_ID}:{sid}', username)
+        pipe.incr(f'{self._key}:presence_version')
+        return pipe.execute()[-1]
+
+    def remove_member(self, sid):
+        pipe = chat_store.pipeline()
+        pipe.hdel(f'{self._key}:members', f'{WORKER_ID}:{sid}')
+        pipe.incr(f'{self._key}:presence_version')
+        return self.members.pop(sid), pipe.execute()[-1]
+
+    def presence_snapshot(self):
+        pipe = chat_store.pipeline()
+        pipe.hvals(f'{self._key}:members')
+        pipe.get(f'{self._key}:presence_version')
+        names, version = pipe.execute()
+        return names, int(version or 0)
+
+    def record(self, msg):
+        msg['id'] = chat_store.incr(f'{self._key}:next_id')
+        pipe = chat_store.pipeline(transaction=False)
+        pipe.zadd(f'{self._key}:history', {json.dumps(msg): msg['id']})
+        pipe.zremrangebyrank(f'{self._key}:history', 0, -(MAX_HISTORY + 1))
+        pipe.execute()
+        return msg
+
+    def history_before(self, before_id, limit):
+        upper = f'({before_id}' if before_id else '+inf'
+        rows = chat_store.zrevrangebyscore(f'{self._key}:history', upper, '-inf', start=0, num=limit + 1)
+        return [json.loads(row) for row in reversed(rows[:limit])], len(rows) > limit
+
+    def tail(self, limit):
+        return [json.loads(row) for row in chat_store.zrange(f'{self._key}:history', -limit, -1)]
+
+    def close(self):
+        if self.members:
+            chat_store.hdel(f'{self._key}:members', *(f'{WORKER_ID}:{sid}' for sid in self.members))
+
+def emit_presence(name, pending, users_list):
+    """Sends (change, message) pairs as one presence_update to members that
+    joined with presence_updates: true, and as the original protocol's
+    user_joined / user_left events, one per change, to everyone else."""
+    pending = sorted(pending, key=lambda item: item[0]['version'])
+    socketio.emit('presence_update', {
+        'room': name,
+        'version': pending[-1][0]['version'],
+        'changes': [change for change, _ in pending],
+        'messages': [message for _, message in pending if message]
+    }, to=f'{name}:presence')
+    for change, message in pending:
+        if 'joined' in change:
+            socketio.emit('user_joined', {
+                'room': name, 'user': change['joined'], 'users_list': users_list, 'message': message
+            }, to=f'{name}:legacy')
+        else:
+            socketio.emit('user_left', {'room': name, 'user': change['left'], 'users_list': users_list}, to=f'{name}:legacy')
+
+rooms = {}
+user_rooms = {}
+batch_clients = set()
+presence_clients = set()
+Gauge('chat_users', 'Users joined to the chat on this worker.', collect=lambda: {(): len(users)})
+Gauge('chat_rooms', 'Chat rooms open on this worker.', collect=lambda: {(): len(rooms)})
+
+def get_room(name, create=False):
+    room = rooms.get(name)
+    if room is None and create and len(rooms) < MAX_ROOMS:
+        room = rooms[name] = (SharedChatRoom if chat_store else ChatRoom)(name)
+    return room
+
+def release_room(room):
+    """Unload an empty room. Its log stays on disk and is reopened on the
+    next join."""
+    if not room.members and room.name != DEFAULT_ROOM:
+        rooms.pop(room.name, None)
+        room.flush_presence()
+        room.flush_messages()
+        room.close()
+
+def close_rooms():
+    for room in list(rooms.values()):
+        room.close()
+
+def sync_chat_logs(interval):
+    while True:
+        eventlet.sleep(interval)
+        for room in list(rooms.values()):
+            try:
+                if room.log:
+                    room.log.sync()
+            except OSError as e:
+                logger.error(f'Chat log sync error in {room.name}: {str(e)}')
+
+def sweep_shared_presence():
+    """Keep this worker's heartbeat alive and remove room members left
+    behind by workers whose heartbeat expired."""
+    heartbeat_key = f'{CHAT_STORE_PREFIX}worker:{WORKER_ID}'
+    while True:
+        try:
+            chat_store.set(heartbeat_key, 1, ex=CHAT_PRESENCE_TTL)
+            alive = {WORKER_ID: True}
+            for name in chat_store.smembers(f'{CHAT_STORE_PREFIX}rooms'):
+                members_key = f'{CHAT_STORE_PREFIX}room:{name}:members'
+                for field, username in chat_store.hgetall(members_key).items():
+                    worker = field.split(':', 1)[0]
+                    if worker not in alive:
+                        alive[worker] = bool(chat_store.exists(f'{CHAT_STORE_PREFIX}worker:{worker}'))
+                    if alive[worker]:
+                        continue
+                    pipe = chat_store.pipeline()
+                    pipe.hdel(members_key, field)
+                    pipe.incr(f'{CHAT_STORE_PREFIX}room:{name}:presence_version')
+                    removed, version = pipe.execute()
+                    if removed:
+                        emit_presence(name, [({'version': version, 'left': username}, None)],
+                                      chat_store.hvals(members_key))
+        except redis.RedisError as e:
+            logger.error(f'Chat store error: {str(e)}')
+        eventlet.sleep(CHAT_PRESENCE_TTL / 3)
+
+get_room(DEFAULT_ROOM, create=True)
+if chat_store:
+    chat_store.set(f'{CHAT_STORE_PREFIX}worker:{WORKER_ID}', 1, ex=CHAT_PRESENCE_TTL)
+    atexit.register(close_rooms)
+    socketio.start_background_task(sweep_shared_presence)
+elif CHAT_LOG_DIR:
+    atexit.register(close_rooms)
+    if CHAT_LOG_FSYNC_MS > 0:
+        socketio.start_background_task(sync_chat_logs, CHAT_LOG_FSYNC_MS / 1000)
+
+def create_file_record(file_id, filename, size, sha256):
+    file_info = {
+        'file_id': file_id,
+        'original_name': filename,
+        'current_name': filename,
+        'size': size,
+        'uploaded_at': datetime.now(timezone.utc).isoformat(),
+        'user_ip': request.remote_addr,
+        'password_hash': None,
+        'is_password_protected': False,
+        'sha256': sha256
+    }
+    metadata_store.add(file_info)
+    return file_info
+
+# --- FILE UPLOAD ROUTES ---
+@app.route('/api/files/upload', methods=['POST'])
+def upload_file():
+    limited = rate_limited_response('upload')
+    if limited:
+        return limited
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file provided'}), 400
+        
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+        
+        filename = secure_filename(file.filename)
+        ext = Path(filename).suffix.lower()
+        
+        if ext not in ALLOWED_EXTENSIONS:
+            return jsonify({'error': f'File type not allowed. Allowed: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
+        
+        over_quota = quota_error(request.remote_addr)
+        if over_quota:
+            return over_quota
+        
+        file_id = str(uuid.uuid4())[:8]
+        
+        try:
+            tmp_path, size, sha256 = stream_to_temp(file.stream, MAX_FILE_SIZE)
+            UPLOAD_BYTES.add(size, 'single')
+        except UploadTooLarge:
+            return jsonify({'error': f'File too large. Maximum size: {max_file_size_label()}'}), 400
+        
+        # The size is only known once the body is in.
+        over_quota = quota_error(request.remote_addr, size)
+        if over_quota:
+            tmp_path.unlink(missing_ok=True)
+            return over_quota
+        
+        publish_upload(file_id, filename, tmp_path, size, sha256)
+        
+        logger.info(f'File uploaded: {file_id} by {request.remote_addr}')
+        
+        return jsonify({
+            'success': True,
             'file_id': file_id,
-            'download_link': download_link
+            'download_link': f"{TUNNEL_URL}/api/files/download/{file_id}"
         }), 201
     
     except Exception as e:
@@ -327,22 +2346,19 @@ def upload_file():
 @app.route('/api/files/<file_id>', methods=['DELETE'])
 def delete_file(file_id):
     try:
-        metadata = load_files_metadata()
+        file_info = metadata_store.get(file_id)
         
-        if file_id not in metadata:
+        if file_info is None:
             return jsonify({'error': 'File not found'}), 404
         
-        file_info = metadata[file_id]
         if file_info.get('user_ip') != request.remote_addr:
             return jsonify({'error': 'Unauthorized'}), 403
         
+        delete_file_record(file_id)
+        
         file_dir = UPLOADS_DIR / file_id
         if file_dir.exists():
-            import shutil
-            shutil.rmtree(file_dir)
-        
-        del metadata[file_id]
-        save_files_metadata(metadata)
+            disk_pool.run(shutil.rmtree, file_dir)
         
         logger.info(f'File deleted: {file_id}')
         
@@ -361,27 +2377,27 @@ def rename_file(file_id):
         if not new_name:
             return jsonify({'error': 'New name is required'}), 400
         
-        metadata = load_files_metadata()
+        file_info = metadata_store.get(file_id)
         
-        if file_id not in metadata:
+        if file_info is None:
             return jsonify({'error': 'File not found'}), 404
         
-        file_info = metadata[file_id]
         if file_info.get('user_ip') != request.remote_addr:
             return jsonify({'error': 'Unauthorized'}), 403
         
         secure_new_name = secure_filename(new_name)
-        file_dir = UPLOADS_DIR / file_id
-        
-        old_path = file_dir / file_info['current_name']
-        new_path = file_dir / secure_new_name
         
-        if old_path.exists():
-            old_path.rename(new_path)
+        # Blob-backed files keep their content under the hash; only the
+        # download name changes.
+        if not file_info.get('sha256'):
+            file_dir = UPLOADS_DIR / file_id
+            old_path = file_dir / file_info['current_name']
+            new_path = file_dir / secure_new_name
+            
+            if old_path.exists():
+                old_path.rename(new_path)
         
-        file_info['current_name'] = secure_new_name
-        metadata[file_id] = file_info
-        save_files_metadata(metadata)
+        metadata_store.update(file_id, current_name=secure_new_name)
         
         logger.info(f'File renamed: {file_id}')
         
@@ -400,20 +2416,19 @@ def set_password(file_id):
         if not password:
             return jsonify({'error': 'Password is required'}), 400
         
-        metadata = load_files_metadata()
+        file_info = metadata_store.get(file_id)
         
-        if file_id not in metadata:
+        if file_info is None:
             return jsonify({'error': 'File not found'}), 404
         
-        file_info = metadata[file_id]
         if file_info.get('user_ip') != request.remote_addr:
             return jsonify({'error': 'Unauthorized'}), 403
         
-        file_info['password_hash'] = generate_password_hash(password)
-        file_info['is_password_protected'] = True
-        
-        metadata[file_id] = file_info
-        save_files_metadata(metadata)
+        metadata_store.update(
+            file_id,
+            password_hash=password_pool.run(generate_password_hash, password),
+            is_password_protected=True
+        )
         
         logger.info(f'Password set for file: {file_id}')
         
@@ -423,7 +2438,7 @@ def set_password(file_id):
         logger.error(f'Password error: {str(e)}')
         return jsonify({'error': str(e)}), 500
 
-def get_password_page(file_id, file_name, error_message=None):
+def password_page_html(file_id, file_name, error_message=None):
     return f"""
     <!DOCTYPE html>
     <html lang="en">
@@ -638,130 +2653,144 @@ def get_password_page(file_id, file_name, error_message=None):
     </html>
     """
 
-@app.route('/api/files/download/<file_id>', methods=['GET'])
-def download_file_get(file_id):
-    try:
-        metadata = load_files_metadata()
-        
-        if file_id not in metadata:
-            return """
-            <!DOCTYPE html>
-            <html lang="en">
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>Error - File Not Found</title>
+PASSWORD_PAGES = {
+    with_error: PageTemplate(password_page_html(
+        page_field('file_id'),
+        page_field('file_name'),
+        page_field('error_message') if with_error else None
+    ))
+    for with_error in (False, True)
+}
+
+def get_password_page(file_id, file_name, error_message=None):
+    return PASSWORD_PAGES[bool(error_message)].render(
+        file_id=file_id,
+        file_name=file_name,
+        error_message=error_message or ''
+    )
+
+DOWNLOAD_ERROR_STYLE = """
                 <style>
                     body { background: #0a0a0c; color: #fff; font-family: Inter, system-ui; display: flex; align-items: center; justify-content: center; height: 100vh; margin: 0; }
                     .container { text-align: center; padding: 3rem; border-radius: 1.5rem; background: rgba(18, 18, 20, 0.4); backdrop-filter: blur(40px); border: 1px solid rgba(139, 92, 246, 0.15); }
                     h1 { color: #ff6b6b; margin: 0 0 1rem; }
                     p { color: rgba(255, 255, 255, 0.5); }
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <h1>❌ File Not Found</h1>
-                    <p>This file may have been deleted or the link is invalid.</p>
-                </div>
-            </body>
-            </html>
-            """, 404
-        
-        file_info = metadata[file_id]
-        
-        if file_info.get('is_password_protected'):
-            return get_password_page(file_id, file_info['current_name']), 403
-        
-        file_dir = UPLOADS_DIR / file_id
-        file_path = file_dir / file_info['current_name']
-        
-        if not file_path.exists():
-            return """
+                </style>"""
+
+def download_error_html(title, heading, message):
+    return f"""
             <!DOCTYPE html>
             <html lang="en">
             <head>
                 <meta charset="UTF-8">
                 <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>Error - Server Error</title>
-                <style>
-                    body { background: #0a0a0c; color: #fff; font-family: Inter, system-ui; display: flex; align-items: center; justify-content: center; height: 100vh; margin: 0; }
-                    .container { text-align: center; padding: 3rem; border-radius: 1.5rem; background: rgba(18, 18, 20, 0.4); backdrop-filter: blur(40px); border: 1px solid rgba(139, 92, 246, 0.15); }
-                    h1 { color: #ff6b6b; margin: 0 0 1rem; }
-                    p { color: rgba(255, 255, 255, 0.5); }
-                </style>
+                <title>{title}</title>{DOWNLOAD_ERROR_STYLE}
             </head>
             <body>
                 <div class="container">
-                    <h1>⚠️ Server Error</h1>
-                    <p>The file could not be found on the server.</p>
+                    <h1>{heading}</h1>
+                    <p>{message}</p>
                 </div>
             </body>
             </html>
-            """, 500
+            """
+
+FILE_NOT_FOUND_PAGE = StaticPage(download_error_html(
+    'Error - File Not Found',
+    '❌ File Not Found',
+    'This file may have been deleted or the link is invalid.'
+), CACHE_CONTROL_ERROR_PAGES)
+FILE_MISSING_PAGE = StaticPage(download_error_html(
+    'Error - Server Error',
+    '⚠️ Server Error',
+    'The file could not be found on the server.'
+), 'no-store')
+DOWNLOAD_ERROR_PAGE = PageTemplate(download_error_html(
+    'Error - Server Error',
+    '⚠️ Server Error',
+    f"An error occurred: {page_field('error')}"
+))
+
+@app.route('/api/files/download/<file_id>', methods=['GET'])
+def download_file_get(file_id):
+    try:
+        file_info = metadata_store.get(file_id)
+        
+        if file_info is None:
+            return FILE_NOT_FOUND_PAGE.response(404)
+        
+        protected = file_info.get('is_password_protected')
+        if protected:
+            token = request.args.get('token') or request.cookies.get(DOWNLOAD_TOKEN_COOKIE)
+            if not verify_download_token(file_info, token):
+                return get_password_page(file_id, file_info['current_name']), 403
+        
+        file_path = stored_file_path(file_info)
+        
+        if not file_path.exists():
+            return FILE_MISSING_PAGE.response(500)
         
-        logger.info(f'File downloaded (no password): {file_id}')
+        if protected:
+            logger.info(f'File downloaded (token): {file_id}')
+        else:
+            logger.info(f'File downloaded (no password): {file_id}')
         
-        return send_file(
-            str(file_path),
-            as_attachment=True,
-            download_name=file_info['current_name']
+        etag, last_modified = upload_validators(file_info)
+        return send_stored_file(
+            file_path,
+            file_info['current_name'],
+            etag=etag,
+            last_modified=last_modified,
+            cache_control=CACHE_CONTROL_PROTECTED_FILES if protected else CACHE_CONTROL_PUBLIC_FILES
         )
     
     except Exception as e:
         logger.error(f'Download error: {str(e)}')
-        return f"""
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Error - Server Error</title>
-            <style>
-                body {{ background: #0a0a0c; color: #fff; font-family: Inter, system-ui; display: flex; align-items: center; justify-content: center; height: 100vh; margin: 0; }}
-                .container {{ text-align: center; padding: 3rem; border-radius: 1.5rem; background: rgba(18, 18, 20, 0.4); backdrop-filter: blur(40px); border: 1px solid rgba(139, 92, 246, 0.15); }}
-                h1 {{ color: #ff6b6b; margin: 0 0 1rem; }}
-                p {{ color: rgba(255, 255, 255, 0.5); }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>⚠️ Server Error</h1>
-                <p>An error occurred: {str(e)}</p>
-            </div>
-        </body>
-        </html>
-        """, 500
+        return DOWNLOAD_ERROR_PAGE.render(error=str(e)), 500
 
 @app.route('/api/files/download/<file_id>', methods=['POST'])
 def download_file_post(file_id):
     try:
-        metadata = load_files_metadata()
+        file_info = metadata_store.get(file_id)
         
-        if file_id not in metadata:
+        if file_info is None:
             return get_password_page(file_id, "Unknown", "File not found"), 404
         
-        file_info = metadata[file_id]
         password = request.form.get('password', '').strip()
         
         if not password:
             return get_password_page(file_id, file_info['current_name'], "Password is required"), 400
         
-        if not check_password_hash(file_info['password_hash'], password):
+        if not password_pool.run(check_password_hash, file_info['password_hash'], password):
             return get_password_page(file_id, file_info['current_name'], "Invalid password"), 401
         
-        file_dir = UPLOADS_DIR / file_id
-        file_path = file_dir / file_info['current_name']
+        file_path = stored_file_path(file_info)
         
         if not file_path.exists():
             return get_password_page(file_id, file_info['current_name'], "File not found on server"), 500
         
         logger.info(f'File downloaded (password protected): {file_id}')
         
-        return send_file(
-            str(file_path),
-            as_attachment=True,
-            download_name=file_info['current_name']
+        # Later GET/range requests for this file can present the token (query
+        # string or cookie) instead of the password.
+        token = mint_download_token(file_info)
+        download_path = f'/api/files/download/{file_id}'
+        
+        etag, last_modified = upload_validators(file_info)
+        response = send_stored_file(
+            file_path,
+            file_info['current_name'],
+            etag=etag,
+            last_modified=last_modified,
+            cache_control=CACHE_CONTROL_PROTECTED_FILES
         )
+        response.headers['X-Download-Token'] = token
+        response.headers['X-Download-Url'] = f"{TUNNEL_URL}{download_path}?token={token}"
+        response.set_cookie(
+            DOWNLOAD_TOKEN_COOKIE, token,
+            max_age=DOWNLOAD_TOKEN_TTL, path=download_path, httponly=True, samesite='Lax'
+        )
+        return response
     
     except Exception as e:
         logger.error(f'Download error: {str(e)}')
@@ -770,34 +2799,695 @@ def download_file_post(file_id):
 @app.route('/api/files/user', methods=['GET'])
 def get_user_files():
     try:
-        metadata = load_files_metadata()
         user_files = []
         
-        for file_id, file_info in metadata.items():
-            if file_info.get('user_ip') == request.remote_addr:
-                user_files.append({
-                    'file_id': file_id,
-                    'name': file_info['current_name'],
-                    'size': file_info['size'],
-                    'uploaded_at': file_info['uploaded_at'],
-                    'is_password_protected': file_info['is_password_protected'],
-                    'download_link': f"{TUNNEL_URL}/api/files/download/{file_id}"
-                })
-        
-        return jsonify({'files': user_files}), 200
+        for file_info in metadata_store.list_by_user(request.remote_addr):
+            file_id = file_info['file_id']
+            user_files.append({
+                'file_id': file_id,
+                'name': file_info['current_name'],
+                'size': file_info['size'],
+                'uploaded_at': file_info['uploaded_at'],
+                'is_password_protected': file_info['is_password_protected'],
+                'download_link': f"{TUNNEL_URL}/api/files/download/{file_id}"
+            })
+        
+        count, total = metadata_store.usage_by_user(request.remote_addr)
+        return jsonify({
+            'files': user_files,
+            'usage': {
+                'files': count,
+                'bytes': total,
+                'max_files': MAX_FILES_PER_USER,
+                'max_bytes': MAX_BYTES_PER_USER or None
+            }
+        }), 200
     
     except Exception as e:
         logger.error(f'Get files error: {str(e)}')
         return jsonify({'error': str(e)}), 500
 
+# --- RESUMABLE UPLOAD ROUTES ---
+# Init/append/finalize protocol modelled on tus: the client declares the file,
+# PATCHes raw chunks at the current Upload-Offset and finalizes once all bytes
+# are in. State lives next to the data in UPLOADS_DIR/<file_id>/ so sessions
+# survive restarts.
+active_upload_writes = set()
+# user_ip -> {file_id: session} of sessions not yet finalized or discarded,
+# so they count towards the owner's quota while they hold disk.
+open_upload_sessions = {}
+
+def track_upload_session(session):
+    open_upload_sessions.setdefault(session['user_ip'], {})[session['file_id']] = session
+
+def untrack_upload_session(file_id):
+    for user_ip, sessions in list(open_upload_sessions.items()):
+        if sessions.pop(file_id, None) is not None and not sessions:
+            del open_upload_sessions[user_ip]
+
+def upload_session_usage(user_ip, exclude=None):
+    """(session count, declared bytes) of user_ip's open upload sessions."""
+    sessions = open_upload_sessions.get(user_ip, {})
+    sizes = [
+        session['size'] for file_id, session in sessions.items()
+        if file_id != exclude and not upload_session_expired(session)
+    ]
+    return len(sizes), sum(sizes)
+
+def load_upload_session(file_id):
+    if not FILE_ID_PATTERN.fullmatch(file_id):
+        return None
+    session_path = UPLOADS_DIR / file_id / UPLOAD_SESSION_FILE
+    try:
+        with open(session_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def upload_session_offset(file_id):
+    try:
+        return os.path.getsize(UPLOADS_DIR / file_id / UPLOAD_PART_FILE)
+    except OSError:
+        return 0
+
+def upload_session_expired(session):
+    return datetime.now(timezone.utc).timestamp() - session['created_at'] > UPLOAD_SESSION_TTL
+
+def discard_upload_session(file_id):
+    untrack_upload_session(file_id)
+    disk_pool.run(shutil.rmtree, UPLOADS_DIR / file_id, ignore_errors=True)
+
+def cleanup_stale_upload_sessions():
+    for session_path in UPLOADS_DIR.glob(f'*/{UPLOAD_SESSION_FILE}'):
+        file_id = session_path.parent.name
+        session = load_upload_session(file_id)
+        # Another worker may be halfway through writing a new session file.
+        if session is None and not is_stale(session_path):
+            continue
+        if session is None or upload_session_expired(session):
+            discard_upload_session(file_id)
+            logger.info(f'Discarded stale upload session: {file_id}')
+        else:
+            track_upload_session(session)
+
+def get_owned_upload_session(file_id):
+    """Returns (session, error_response); exactly one of them is None."""
+    session = load_upload_session(file_id)
+    if session is None:
+        return None, (jsonify({'error': 'Upload not found'}), 404)
+    if session['user_ip'] != request.remote_addr:
+        return None, (jsonify({'error': 'Unauthorized'}), 403)
+    if upload_session_expired(session):
+        discard_upload_session(file_id)
+        return None, (jsonify({'error': 'Upload session expired'}), 410)
+    return session, None
+
+def upload_offset_response(session, offset, status=200):
+    response = jsonify({'file_id': session['file_id'], 'offset': offset, 'size': session['size']})
+    response.status_code = status
+    response.headers['Upload-Offset'] = str(offset)
+    response.headers['Upload-Length'] = str(session['size'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/files/uploads', methods=['POST'])
+def init_upload():
+    limited = rate_limited_response('upload')
+    if limited:
+        return limited
+    try:
+        data = request.get_json(silent=True) or {}
+        filename = secure_filename(str(data.get('filename', '')))
+        size = data.get('size')
+        sha256 = data.get('sha256')
+        
+        if not filename:
+            return jsonify({'error': 'No file selected'}), 400
+        
+        ext = Path(filename).suffix.lower()
+        if ext not in ALLOWED_EXTENSIONS:
+            return jsonify({'error': f'File type not allowed. Allowed: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
+        
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            return jsonify({'error': 'File size is required'}), 400
+        
+        if size > MAX_FILE_SIZE:
+            return jsonify({'error': f'File too large. Maximum size: {max_file_size_label()}'}), 400
+        
+        if sha256 is not None and not re.fullmatch(r'[0-9a-fA-F]{64}', str(sha256)):
+            return jsonify({'error': 'Invalid sha256'}), 400
+        
+        over_quota = quota_error(request.remote_addr, size)
+        if over_quota:
+            return over_quota
+        
+        file_id = str(uuid.uuid4())[:8]
+        
+        # Content this client already uploaded is registered straight away; no
+        # bytes need to be sent.
+        if sha256 and publish_duplicate(file_id, filename, size, sha256.lower(), request.remote_addr):
+            logger.info(f'File uploaded (deduplicated): {file_id} by {request.remote_addr}')
+            return jsonify({
+                'success': True,
+                'complete': True,
+                'file_id': file_id,
+                'sha256': sha256.lower(),
+                'download_link': f"{TUNNEL_URL}/api/files/download/{file_id}"
+            }), 201
+        
+        session = {
+            'file_id': file_id,
+            'filename': filename,
+            'size': size,
+            'sha256': sha256.lower() if sha256 else None,
+            'user_ip': request.remote_addr,
+            'created_at': datetime.now(timezone.utc).timestamp()
+        }
+        
+        upload_dir = UPLOADS_DIR / file_id
+        upload_dir.mkdir(parents=True)
+        (upload_dir / UPLOAD_PART_FILE).touch()
+        with open(upload_dir / UPLOAD_SESSION_FILE, 'w') as f:
+            json.dump(session, f)
+        track_upload_session(session)
+        
+        logger.info(f'Upload session started: {file_id} by {request.remote_addr}')
+        
+        response = upload_offset_response(session, 0, 201)
+        response.headers['Location'] = f'/api/files/uploads/{file_id}'
+        return response
+    
+    except Exception as e:
+        logger.error(f'Upload init error: {str(e)}')
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/files/uploads/<file_id>', methods=['GET'])
+def get_upload_offset(file_id):
+    session, error = get_owned_upload_session(file_id)
+    if error:
+        return error
+    return upload_offset_response(session, upload_session_offset(file_id))
+
+@app.route('/api/files/uploads/<file_id>', methods=['PATCH'])
+def append_upload_chunk(file_id):
+    try:
+        session, error = get_owned_upload_session(file_id)
+        if error:
+            return error
+        
+        try:
+            client_offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return jsonify({'error': 'Upload-Offset header is required'}), 400
+        
+        if (request.content_length or 0) > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify({'error': 'Chunk too large'}), 413
+        
+        if file_id in active_upload_writes:
+            return jsonify({'error': 'Another chunk is being written for this upload'}), 409
+        
+        offset = upload_session_offset(file_id)
+        if client_offset != offset:
+            return upload_offset_response(session, offset, 409)
+        
+        active_upload_writes.add(file_id)
+        try:
+            fd = os.open(UPLOADS_DIR / file_id / UPLOAD_PART_FILE, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+            try:
+                while True:
+                    chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if offset + len(chunk) > session['size']:
+                        os.ftruncate(fd, client_offset)
+                        return jsonify({'error': 'Chunk exceeds declared file size'}), 413
+                    offset = write_at(fd, chunk, offset)
+            finally:
+                os.close(fd)
+        finally:
+            active_upload_writes.discard(file_id)
+        UPLOAD_BYTES.add(offset - client_offset, 'resumable')
+        
+        return upload_offset_response(session, offset)
+    
+    except Exception as e:
+        logger.error(f'Upload chunk error: {str(e)}')
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/files/uploads/<file_id>/finalize', methods=['POST'])
+def finalize_upload(file_id):
+    try:
+        session, error = get_owned_upload_session(file_id)
+        if error:
+            return error
+        
+        if file_id in active_upload_writes:
+            return jsonify({'error': 'Another chunk is being written for this upload'}), 409
+        
+        offset = upload_session_offset(file_id)
+        if offset != session['size']:
+            return upload_offset_response(session, offset, 409)
+        
+        over_quota = quota_error(request.remote_addr, offset, session_id=file_id)
+        if over_quota:
+            return over_quota
+        
+        part_path = UPLOADS_DIR / file_id / UPLOAD_PART_FILE
+        sha256 = hash_pool.run(hash_file, part_path)
+        
+        if session['sha256'] and sha256 != session['sha256']:
+            discard_upload_session(file_id)
+            logger.info(f'Upload hash mismatch: {file_id}')
+            return jsonify({'error': 'Hash mismatch, upload discarded'}), 422
+        
+        publish_upload(file_id, session['filename'], part_path, offset, sha256)
+        discard_upload_session(file_id)
+        
+        logger.info(f'File uploaded (resumable): {file_id} by {request.remote_addr}')
+        
+        return jsonify({
+            'success': True,
+            'file_id': file_id,
+            'sha256': sha256,
+            'download_link': f"{TUNNEL_URL}/api/files/download/{file_id}"
+        }), 201
+    
+    except Exception as e:
+        logger.error(f'Upload finalize error: {str(e)}')
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/files/uploads/<file_id>', methods=['DELETE'])
+def abort_upload(file_id):
+    session, error = get_owned_upload_session(file_id)
+    if error:
+        return error
+    if file_id in active_upload_writes:
+        return jsonify({'error': 'Another chunk is being written for this upload'}), 409
+    discard_upload_session(file_id)
+    logger.info(f'Upload session aborted: {file_id}')
+    return jsonify({'success': True}), 200
+
+with startup_lock():
+    cleanup_stale_upload_sessions()
+    migrate_legacy_uploads()
+
+# --- RELEASE INDEX ---
+# releases/<version>/ is scanned once at startup and again only when a file is
+# added, replaced or removed; update checks, version listings and download
+# lookups are then answered from the in-memory snapshot.
+RELEASES_RESCAN_INTERVAL = int(os.getenv('RELEASES_RESCAN_INTERVAL', 10))
+CACHE_CONTROL_RELEASES = os.getenv('CACHE_CONTROL_RELEASES', 'public, max-age=86400')
+RELEASE_NOTES_FILES = ('notes.md', 'notes.txt', 'RELEASE_NOTES.md')
+
+# Tauri updater bundles per target OS, in order of preference.
+UPDATER_BUNDLES = {
+    'windows': ('.msi.zip', '.nsis.zip', '.msi', '.exe'),
+    'darwin': ('.app.tar.gz',),
+    'linux': ('.AppImage.tar.gz', '.AppImage'),
+}
+ARCH_ALIASES = {
+    'x86_64': ('x86_64', 'x64', 'amd64'),
+    'aarch64': ('aarch64', 'arm64'),
+    'i686': ('i686', 'x86'),
+    'armv7': ('armv7',),
+}
+
+# Binary patches from the previous DELTA_PATCH_VERSIONS releases to the latest
+# one, built in the background with zstd (--patch-from) or bsdiff, whichever
+# is installed. Patches that save too little are not advertised.
+DELTA_PATCH_VERSIONS = int(os.getenv('DELTA_PATCH_VERSIONS', 3))
+DELTA_PATCH_FORMAT = os.getenv('DELTA_PATCH_FORMAT', 'auto').lower()
+DELTA_PATCH_MAX_RATIO = 0.8
+PATCHES_DIR = RELEASES_DIR / '.patches'
+PATCH_EXTENSIONS = {'zstd': '.zst', 'bsdiff': '.bsdiff'}
+
+def delta_patch_format():
+    if DELTA_PATCH_FORMAT in ('auto', 'zstd') and zstandard is not None:
+        return 'zstd'
+    if DELTA_PATCH_FORMAT in ('auto', 'bsdiff') and bsdiff4 is not None:
+        return 'bsdiff'
+    return None
+
+def bundle_suffix(name):
+    suffixes = sorted((s for bundles in UPDATER_BUNDLES.values() for s in bundles), key=len, reverse=True)
+    return next((suffix for suffix in suffixes if name.endswith(suffix)), None)
+
+def make_delta_patch(old_path, new_path, patch_path, patch_format):
+    """Writes the patch turning old_path into new_path and returns its sha256,
+    size and (for zstd) the window log needed to apply it. CPU heavy; run it
+    on a native thread."""
+    old = Path(old_path).read_bytes()
+    new = Path(new_path).read_bytes()
+    window_log = None
+    if patch_format == 'zstd':
+        # Apply with: zstd -d --long=<window_log> --patch-from=<old> <patch>
+        window_log = min(max(max(len(old), len(new)).bit_length(), 10), 31)
+        params = zstandard.ZstdCompressionParameters.from_level(19, window_log=window_log, enable_ldm=True)
+        dict_data = zstandard.ZstdCompressionDict(old, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        data = zstandard.ZstdCompressor(dict_data=dict_data, compression_params=params).compress(new)
+    else:
+        data = bsdiff4.diff(old, new)
+
+    patch_path.parent.mkdir(parents=True, exist_ok=True)
+    replace_file(patch_path, data)
+    return {'sha256': hashlib.sha256(data).hexdigest(), 'size': len(data), 'window_log': window_log}
+
+def replace_file(path, data):
+    """Writes data to a temp file of its own next to path and renames it over
+    path, so workers building the same patch never write into one file and
+    readers see either the old or the new contents."""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        # mkstemp creates the file 0600; a fronting server serves patches too.
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def parse_version(version):
+    """Sort key for a semver string; pre-releases sort before the release."""
+    match = re.fullmatch(r'v?(\d+(?:\.\d+)*)(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?', str(version).strip())
+    if not match:
+        return None
+    numbers = tuple(int(part) for part in match.group(1).split('.'))
+    numbers += (0,) * (3 - len(numbers))
+    if not match.group(2):
+        return (numbers, 1, ())
+    prerelease = tuple((0, int(part), '') if part.isdigit() else (1, 0, part) for part in match.group(2).split('.'))
+    return (numbers, 0, prerelease)
+
+def artifact_arch(name):
+    lowered = name.lower()
+    for arch, aliases in ARCH_ALIASES.items():
+        if any(re.search(rf'(^|[_.-]){alias}([_.-]|$)', lowered) for alias in aliases):
+            return arch
+    return None
+
+def canonical_arch(name):
+    """The ARCH_ALIASES key for an arch name from a client, or '' for one we
+    do not know, which only matches artifacts without an arch."""
+    lowered = name.lower()
+    return next((arch for arch, aliases in ARCH_ALIASES.items() if lowered in aliases), '')
+
+class ReleaseIndex:
+    def __init__(self, root):
+        self.root = root
+        self._fingerprint = None
+        # (relative path, size, mtime_ns) -> sha256, so a rescan only hashes
+        # files that actually changed.
+        self._hashes = {}
+        self.versions = []
+        self.by_version = {}
+        self.files = {}
+        self.latest = None
+        self._updates = {}
+        # (latest artifact path, from version) -> patch entry
+        self.patches = {}
+        self._patch_lock = threading.Lock()
+
+    def _scan(self):
+        found = []
+        for version_dir in self.root.iterdir():
+            if not version_dir.is_dir() or parse_version(version_dir.name) is None:
+                continue
+            for path in version_dir.iterdir():
+                if path.is_file():
+                    stat = path.stat()
+                    found.append((path.relative_to(self.root).as_posix(), stat.st_size, stat.st_mtime_ns))
+        return tuple(sorted(found))
+
+    def refresh(self, hasher=None):
+        """Rebuilds the snapshot if anything under the releases dir changed.
+        hasher lets the background watcher push hashing off the hub."""
+        fingerprint = self._scan()
+        if fingerprint == self._fingerprint:
+            return False
+
+        hasher = hasher or hash_file
+        hashes = {}
+        versions = {}
+        for relative_path, size, mtime_ns in fingerprint:
+            version_name, name = relative_path.split('/', 1)
+            version = versions.setdefault(version_name, {
+                'version': version_name.lstrip('v'),
+                'notes': '',
+                'pub_date': None,
+                'files': [],
+            })
+            path = self.root / relative_path
+            if name in RELEASE_NOTES_FILES:
+                version['notes'] = path.read_text(encoding='utf-8', errors='replace').strip()
+                continue
+            if name.endswith('.sig'):
+                continue
+
+            key = (relative_path, size, mtime_ns)
+            hashes[key] = self._hashes.get(key) or hasher(path)
+            signature_path = path.with_name(name + '.sig')
+            modified = datetime.fromtimestamp(mtime_ns / 1e9, timezone.utc)
+            version['files'].append({
+                'name': name,
+                'path': relative_path,
+                'size': size,
+                'sha256': hashes[key],
+                'signature': signature_path.read_text().strip() if signature_path.exists() else None,
+                'modified': modified,
+                'arch': artifact_arch(name),
+            })
+            if version['pub_date'] is None or modified > version['pub_date']:
+                version['pub_date'] = modified
+
+        ordered = sorted(versions.values(), key=lambda v: parse_version(v['version']))
+        by_version = {v['version']: v for v in ordered}
+        # LATEST_VERSION pins the advertised release; otherwise the newest stable
+        # one wins, falling back to a pre-release only if that is all there is.
+        stable = [v for v in ordered if parse_version(v['version'])[1] == 1]
+        latest = by_version.get(LATEST_VERSION.lstrip('v')) or (stable or ordered or [None])[-1]
+
+        # Swap in the new snapshot in one go; readers never see a partial index.
+        self._hashes = hashes
+        self.versions = ordered
+        self.by_version = by_version
+        self.files = {f['path']: f for v in ordered for f in v['files']}
+        self.latest = latest
+        self._updates = {}
+        self.patches = {}
+        self._fingerprint = fingerprint
+        logger.info(f"Release index: {len(ordered)} versions, latest {latest['version'] if latest else 'none'}")
+        return True
+
+    def select_artifact(self, version, target_os, arch=None):
+        for suffix in UPDATER_BUNDLES.get(target_os, ()):
+            for file in version['files']:
+                if file['name'].endswith(suffix) and (arch is None or file['arch'] in (None, arch)):
+                    return file
+        return None
+
+    def update_for(self, target, arch=None, from_version=None):
+        """Tauri updater payload for the latest release on target, memoized
+        until the next rescan. None when there is nothing to offer. A delta
+        patch is added when one exists from from_version."""
+        # Memo keys are limited to known OSes and canonical archs, so clients
+        # cannot grow the memo with made-up values.
+        target_os, _, target_arch = target.lower().partition('-')
+        if target_os not in UPDATER_BUNDLES:
+            return None
+        arch = arch or target_arch
+        key = (target_os, canonical_arch(arch) if arch else None)
+        if key not in self._updates:
+            payload = None
+            latest = self.latest
+            artifact = self.select_artifact(latest, *key) if latest else None
+            if artifact:
+                payload = {
+                    'version': latest['version'],
+                    'notes': latest['notes'],
+                    'pub_date': latest['pub_date'].isoformat().replace('+00:00', 'Z'),
+                    'url': f"{TUNNEL_URL}/download/{quote(artifact['path'])}",
+                    'signature': artifact['signature'] or '',
+                    'sha256': artifact['sha256'],
+                    'size': artifact['size'],
+                }
+            self._updates[key] = (payload, artifact['path'] if artifact else None)
+
+        payload, artifact_path = self._updates[key]
+        patch = self.patches.get((artifact_path, str(from_version or '').lstrip('v')))
+        if payload is not None and patch is not None:
+            return {**payload, 'patch': patch['advertised']}
+        return payload
+
+    def _patch_for(self, source, source_version, artifact, latest, patch_format):
+        patch_relative = (
+            f"{PATCHES_DIR.name}/{source_version['version']}/{latest['version']}/"
+            f"{artifact['name']}{PATCH_EXTENSIONS[patch_format]}"
+        )
+        patch_path = self.root / patch_relative
+        meta_path = patch_path.with_name(patch_path.name + '.json')
+
+        meta = None
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if not meta or meta.get('from_sha256') != source['sha256'] or meta.get('to_sha256') != artifact['sha256'] \
+                or not patch_path.exists():
+            meta = hash_pool.run(make_delta_patch, self.root / source['path'], self.root / artifact['path'],
+                                 patch_path, patch_format)
+            meta.update(from_sha256=source['sha256'], to_sha256=artifact['sha256'], format=patch_format)
+            replace_file(meta_path, json.dumps(meta).encode())
+            logger.info(f"Built delta patch {source_version['version']} -> {latest['version']}: "
+                        f"{artifact['name']} ({meta['size']} of {artifact['size']} bytes)")
+
+        return {
+            'name': patch_path.name,
+            'path': patch_relative,
+            'size': meta['size'],
+            'sha256': meta['sha256'],
+            'modified': datetime.fromtimestamp(patch_path.stat().st_mtime, timezone.utc),
+            'advertised': {
+                'from': source_version['version'],
+                'format': patch_format,
+                'url': f"{TUNNEL_URL}/download/{quote(patch_relative)}",
+                'sha256': meta['sha256'],
+                'size': meta['size'],
+                'window_log': meta['window_log'],
+                'target_sha256': artifact['sha256'],
+            },
+        }
+
+    def build_patches(self):
+        """Builds (or reloads from disk) patches from the previous releases to
+        the latest one for every updater bundle, then publishes them."""
+        patch_format = delta_patch_format()
+        if patch_format is None or DELTA_PATCH_VERSIONS <= 0:
+            return
+        # Builds run one at a time; a queued one reuses patches already on disk.
+        with self._patch_lock:
+            self._build_patches(patch_format)
+
+    def _build_patches(self, patch_format):
+        latest = self.latest
+        if latest is None:
+            return
+
+        latest_key = parse_version(latest['version'])
+        previous = [v for v in self.versions if parse_version(v['version']) < latest_key][-DELTA_PATCH_VERSIONS:]
+        patches = {}
+        for artifact in latest['files']:
+            kind = bundle_suffix(artifact['name'])
+            if kind is None:
+                continue
+            for version in previous:
+                source = next((f for f in version['files']
+                               if bundle_suffix(f['name']) == kind and f['arch'] == artifact['arch']), None)
+                if source is None:
+                    continue
+                try:
+                    patch = self._patch_for(source, version, artifact, latest, patch_format)
+                except Exception as e:
+                    logger.error(f"Delta patch error ({version['version']} -> {latest['version']}): {str(e)}")
+                    continue
+                if patch['size'] < artifact['size'] * DELTA_PATCH_MAX_RATIO:
+                    patches[(artifact['path'], version['version'])] = patch
+
+        # A rescan may have replaced the snapshot while patches were building.
+        if self.latest is not latest:
+            return
+        self.files = {**self.files, **{patch['path']: patch for patch in patches.values()}}
+        self.patches = patches
+
+        for stale_dir in PATCHES_DIR.glob('*/*'):
+            if stale_dir.is_dir() and stale_dir.name != latest['version']:
+                disk_pool.run(shutil.rmtree, stale_dir, ignore_errors=True)
+
+    def watch(self, interval):
+        while True:
+            eventlet.sleep(interval)
+            try:
+                if self.refresh(hasher=lambda path: hash_pool.run(hash_file, path)):
+                    self.build_patches()
+            except Exception as e:
+                logger.error(f'Release index error: {str(e)}')
+
+release_index = ReleaseIndex(RELEASES_DIR)
+release_index.refresh()
+socketio.start_background_task(release_index.build_patches)
+if RELEASES_RESCAN_INTERVAL > 0:
+    socketio.start_background_task(release_index.watch, RELEASES_RESCAN_INTERVAL)
+
 # --- UPDATER ROUTES ---
 @app.route('/health')
 def health():
     return jsonify({'status': 'ok', 'server': 'OxcyCombined'})
 
-@app.route('/')
-def index():
-    return """
+@app.route('/api/stats')
+@admin_required
+def stats():
+    return jsonify({
+        'rate_limits': rate_limiter.stats(),
+        'ai_cache': ai_cache.stats(),
+        'ai_queue': ai_admission.stats(),
+        'worker_pools': {name: pool.stats() for name, pool in worker_pools.items()}
+    })
+
+@app.route('/metrics')
+@admin_required
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+def number_param(data, name, default):
+    value = data.get(name, default)
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+        return None
+    return value
+
+@app.route('/admin/profiler')
+@admin_required
+def profiler_status():
+    return jsonify(profiler.stats())
+
+@app.route('/admin/profiler/start', methods=['POST'])
+@admin_required
+def start_profiler():
+    data = request.get_json(silent=True) or {}
+    interval_ms = number_param(data, 'interval_ms', 10)
+    seconds = number_param(data, 'seconds', 60)
+    if not interval_ms or not seconds:
+        return jsonify({'error': 'interval_ms and seconds must be positive numbers'}), 400
+    if not profiler.start(max(interval_ms, 1) / 1000, min(seconds, PROFILER_MAX_SECONDS)):
+        return jsonify({'error': 'Profiler already running'}), 409
+    return jsonify(profiler.stats())
+
+@app.route('/admin/profiler/stop', methods=['POST'])
+@admin_required
+def stop_profiler():
+    profiler.stop()
+    return jsonify(profiler.stats())
+
+@app.route('/admin/profiler/stacks')
+@admin_required
+def profiler_stacks():
+    return Response(profiler.collapsed(), mimetype='text/plain')
+
+@app.route('/admin/hub-blocks', methods=['GET', 'POST'])
+@admin_required
+def hub_blocks():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        threshold_ms = number_param(data, 'threshold_ms', None)
+        if threshold_ms is None:
+            return jsonify({'error': 'threshold_ms must be 0 or a positive number'}), 400
+        hub_watchdog.configure(threshold_ms)
+    return jsonify(hub_watchdog.stats())
+
+LANDING_PAGE = StaticPage("""
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -899,14 +3589,475 @@ def index():
         </div>
     </body>
     </html>
-    """, 403
+    """, CACHE_CONTROL_ERROR_PAGES)
+
+@app.route('/')
+def index():
+    return LANDING_PAGE.response(403)
+
+@app.route('/updates')
+def check_updates():
+    current = request.args.get('version', '')
+    target = request.args.get('target', 'windows-x86_64')
+    arch = request.args.get('arch')
+    
+    current_key = parse_version(current)
+    if current_key is None:
+        return jsonify({'error': 'Invalid version'}), 400
+    
+    update = release_index.update_for(target, arch, from_version=current)
+    if update is None or parse_version(update['version']) <= current_key:
+        return '', 204
+    
+    return jsonify(update), 200
+
+@app.route('/versions')
+def list_versions():
+    latest = release_index.latest
+    return jsonify({
+        'latest': latest['version'] if latest else None,
+        'versions': [
+            {
+                'version': version['version'],
+                'pub_date': version['pub_date'].isoformat() if version['pub_date'] else None,
+                'files': [
+                    {
+                        'name': file['name'],
+                        'size': file['size'],
+                        'sha256': file['sha256'],
+                        'url': f"{TUNNEL_URL}/download/{quote(file['path'])}"
+                    }
+                    for file in version['files']
+                ]
+            }
+            for version in reversed(release_index.versions)
+        ]
+    })
+
+@app.route('/download/<path:filename>')
+def download_release(filename):
+    # Only indexed artifacts are served, which also rules out path traversal.
+    file = release_index.files.get(filename)
+    if file is None or not (RELEASES_DIR / file['path']).exists():
+        return not_found_error(None)
+    
+    return send_stored_file(
+        RELEASES_DIR / file['path'],
+        file['name'],
+        etag=file['sha256'],
+        last_modified=file['modified'],
+        cache_control=CACHE_CONTROL_RELEASES
+    )
 
 # --- AI ENDPOINTS ---
-GROQ_API_KEY = "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"
-GROQ_API_URL = "https://api.groq.com/openai/v1"
+GROQ_API_KEY = os.getenv('GROQ_API_KEY', "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")
+GROQ_API_URL = os.getenv('GROQ_API_URL', "https://api.groq.com/openai/v1")
+AI_MODEL = 'llama-3.1-8b-instant'
+AI_TEMPERATURE = 0.7
+AI_MAX_TOKENS = 2000
+AI_CONNECT_TIMEOUT = 5
+AI_READ_TIMEOUT = 30
+AI_POOL_SIZE = int(os.getenv('AI_POOL_SIZE', 10))
+
+AI_CACHE_SIZE = int(os.getenv('AI_CACHE_SIZE', 256))
+AI_CACHE_MAX_BYTES = int(os.getenv('AI_CACHE_MAX_MB', 8)) * 1024 * 1024
+AI_CACHE_TTL = int(os.getenv('AI_CACHE_TTL', 3600))
+
+class AIResponseCache:
+    """LRU cache of AI answers that expire after AI_CACHE_TTL, bounded by
+    entry count and total size in bytes. Concurrent misses for the same key
+    are single-flighted, streamed or not: the first caller asks upstream
+    and the rest wait on its Event for the same answer or error. A stream
+    that ends early hands no answer over, and its waiters ask again."""
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.size = 0
+        self.hits = self.misses = self.coalesced = self.evictions = 0
+
+    @staticmethod
+    def key(payload):
+        canonical = {field: payload[field] for field in ('model', 'messages', 'temperature', 'max_tokens')}
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.size -= size
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry:
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def put(self, key, content):
+        size = len(content.encode())
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, content, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def lookup(self, key):
+        """Returns (answer, None) for a cached answer or one shared from a
+        concurrent upstream call, else (None, flight): the caller now owns
+        the upstream call and must pass flight to finish()."""
+        content = self.get(key)
+        while content is None:
+            waiter = self.inflight.get(key)
+            if waiter is None:
+                flight = self.inflight[key] = Event()
+                return None, flight
+            self.misses -= 1
+            self.coalesced += 1
+            content = waiter.wait()
+            if content is None:
+                self.coalesced -= 1
+                self.misses += 1
+        return content, None
+
+    def finish(self, key, flight, content=None, error=None):
+        """Caches the answer and wakes the waiters of flight; without an
+        answer or error they retry on their own. Only the first call counts."""
+        if self.inflight.get(key) is flight:
+            del self.inflight[key]
+        if flight.ready():
+            return
+        if error is not None:
+            flight.send_exception(error)
+            return
+        if content is not None:
+            self.put(key, content)
+        flight.send(content)
+
+    def get_or_compute(self, key, compute):
+        content, flight = self.lookup(key)
+        if flight is None:
+            return content
+        try:
+            content = compute()
+        except Exception as e:
+            self.finish(key, flight, error=e)
+            raise
+        finally:
+            self.finish(key, flight, content)
+        return content
+
+    def record_stream(self, key, flight, tokens):
+        """Passes tokens through and hands the answer to finish() once the
+        stream completes. The caller finishes flight for abandoned streams."""
+        parts = []
+        for token in tokens:
+            parts.append(token)
+            yield token
+        self.finish(key, flight, ''.join(parts))
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            'hit_ratio': round((self.hits + self.coalesced) / lookups, 3) if lookups else None
+        }
+
+ai_cache = AIResponseCache(AI_CACHE_SIZE, AI_CACHE_MAX_BYTES, AI_CACHE_TTL)
+Counter('ai_cache_lookups_total', 'AI cache lookups by result.', ('result',), collect=lambda: {
+    'hit': ai_cache.hits, 'miss': ai_cache.misses, 'coalesced': ai_cache.coalesced
+})
+Counter('ai_cache_evictions_total', 'AI answers evicted from the cache.', collect=lambda: {(): ai_cache.evictions})
+Gauge('ai_cache_bytes', 'Size of cached AI answers.', collect=lambda: {(): ai_cache.size})
+Gauge('ai_cache_entries', 'Cached AI answers.', collect=lambda: {(): len(ai_cache.entries)})
+
+AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', 4))
+AI_QUEUE_SIZE = int(os.getenv('AI_QUEUE_SIZE', 32))
+AI_QUEUE_TIMEOUT = float(os.getenv('AI_QUEUE_TIMEOUT', 10))
+
+class AIOverloaded(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class FairAdmission:
+    """At most `limit` upstream AI calls at once. Callers beyond that wait in
+    a FIFO per client, and a freed slot is handed to the next client in
+    round-robin order, so one client with many requests cannot starve the
+    rest. At most `max_waiting` callers wait, each for at most `timeout`
+    seconds; everything beyond that is refused straight away."""
+
+    def __init__(self, limit, max_waiting, timeout):
+        self.limit = max(1, limit)
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.queues = OrderedDict()
+        self.hold_seconds = 1.0
+        self.admitted = self.rejected = self.timed_out = 0
+        self.total_wait = self.max_wait = 0.0
+
+    def retry_after(self):
+        """Rough seconds until a slot frees up for a new caller."""
+        return max(1, int(self.hold_seconds * (self.waiting + 1) / self.limit + 0.999))
+
+    def acquire(self, client):
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            self.admitted += 1
+            return time.monotonic()
+        if self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise AIOverloaded('AI service busy', self.retry_after())
+
+        ticket = Event()
+        queue = self.queues.setdefault(client, deque())
+        queue.append(ticket)
+        self.waiting += 1
+        started = time.monotonic()
+        with eventlet.Timeout(self.timeout, False):
+            ticket.wait()
+        if not ticket.ready():
+            queue.remove(ticket)
+            if not queue and self.queues.get(client) is queue:
+                del self.queues[client]
+            self.waiting -= 1
+            self.timed_out += 1
+            raise AIOverloaded('AI queue wait timed out', self.retry_after())
+
+        waited = time.monotonic() - started
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self.admitted += 1
+        return time.monotonic()
+
+    def release(self, acquired_at):
+        self.hold_seconds = 0.8 * self.hold_seconds + 0.2 * (time.monotonic() - acquired_at)
+        if not self.queues:
+            self.active -= 1
+            return
+        # The slot passes straight to the next client's oldest waiter, and
+        # that client moves to the back of the rotation.
+        client, queue = next(iter(self.queues.items()))
+        ticket = queue.popleft()
+        if queue:
+            self.queues.move_to_end(client)
+        else:
+            del self.queues[client]
+        self.waiting -= 1
+        ticket.send(True)
+
+    @contextmanager
+    def slot(self, client):
+        acquired_at = self.acquire(client)
+        try:
+            yield
+        finally:
+            self.release(acquired_at)
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'limit': self.limit,
+            'waiting': self.waiting,
+            'waiting_clients': len(self.queues),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'avg_wait_ms': round(self.total_wait * 1000 / self.admitted, 1) if self.admitted else 0,
+            'max_wait_ms': round(self.max_wait * 1000, 1)
+        }
+
+ai_admission = FairAdmission(AI_MAX_CONCURRENCY, AI_QUEUE_SIZE, AI_QUEUE_TIMEOUT)
+Gauge('ai_queue_requests', 'AI requests holding or waiting for an upstream slot.', ('state',), collect=lambda: {
+    'active': ai_admission.active, 'waiting': ai_admission.waiting
+})
+Counter('ai_queue_admissions_total', 'AI requests by admission outcome.', ('outcome',), collect=lambda: {
+    'admitted': ai_admission.admitted, 'rejected': ai_admission.rejected, 'timed_out': ai_admission.timed_out
+})
+Counter('ai_queue_wait_seconds_total', 'Time admitted AI requests spent waiting for a slot.', collect=lambda: {(): ai_admission.total_wait})
+
+class AITokenStream:
+    """Iterator over an answer's tokens. close() runs the cleanup callbacks
+    (closing the upstream response, freeing the admission slot) even if the
+    stream was never iterated, which a generator's finally cannot do."""
+
+    def __init__(self, tokens, on_close=()):
+        self.tokens = iter(tokens)
+        self.on_close = list(on_close)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.tokens)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        callbacks, self.on_close = self.on_close, []
+        for callback in callbacks:
+            callback()
+
+class AIUpstreamError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f'AI API Error: {status_code}')
+        self.status_code = status_code
+
+def create_groq_session():
+    """One keep-alive connection pool for all Groq calls, so only the first
+    request pays for the TCP and TLS handshakes."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=AI_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Authorization': f'Bearer {GROQ_API_KEY}',
+        'Content-Type': 'application/json'
+    })
+    return session
+
+groq_session = create_groq_session()
+
+def groq_payload(messages, stream=False):
+    payload = {
+        'model': AI_MODEL,
+        'messages': messages,
+        'temperature': AI_TEMPERATURE,
+        'max_tokens': AI_MAX_TOKENS,
+    }
+    if stream:
+        payload['stream'] = True
+    return payload
+
+def groq_post(payload, stream=False):
+    response = groq_session.post(
+        f'{GROQ_API_URL}/chat/completions',
+        json=payload,
+        stream=stream,
+        timeout=(AI_CONNECT_TIMEOUT, AI_READ_TIMEOUT)
+    )
+    if response.status_code != 200:
+        AI_UPSTREAM_ERRORS.inc(str(response.status_code))
+        logger.error(f'Groq API Error: {response.status_code} - {response.text}')
+        response.close()
+        raise AIUpstreamError(response.status_code)
+    return response
+
+def groq_complete(messages, client):
+    payload = groq_payload(messages)
+
+    def fetch():
+        with ai_admission.slot(client):
+            started = time.perf_counter()
+            result = groq_post(payload).json()
+            AI_UPSTREAM_SECONDS.observe(time.perf_counter() - started, 'complete')
+        return result.get('choices', [{}])[0].get('message', {}).get('content', 'No response')
+
+    return ai_cache.get_or_compute(AIResponseCache.key(payload), fetch)
+
+def groq_token_stream(messages, client):
+    """Tokens of the answer: the cached answer, or the one shared from an
+    identical request already in flight, in one piece; else the live
+    upstream stream, which is cached once it completes and holds an
+    admission slot until closed. Queue and upstream errors are raised here,
+    before the first token."""
+    payload = groq_payload(messages, stream=True)
+    key = AIResponseCache.key(payload)
+    cached, flight = ai_cache.lookup(key)
+    if flight is None:
+        return AITokenStream([cached])
+
+    try:
+        acquired_at = ai_admission.acquire(client)
+    except Exception as e:
+        ai_cache.finish(key, flight, error=e)
+        raise
+    started = time.perf_counter()
+    try:
+        upstream = groq_post(payload, stream=True)
+    except BaseException as e:
+        ai_admission.release(acquired_at)
+        ai_cache.finish(key, flight, error=e if isinstance(e, Exception) else None)
+        raise
+    AI_UPSTREAM_SECONDS.observe(time.perf_counter() - started, 'stream_start')
+    return AITokenStream(
+        ai_cache.record_stream(key, flight, iter_groq_tokens(upstream)),
+        [
+            upstream.close,
+            lambda: ai_cache.finish(key, flight),
+            lambda: ai_admission.release(acquired_at),
+            lambda: AI_UPSTREAM_SECONDS.observe(time.perf_counter() - started, 'stream')
+        ]
+    )
+
+def iter_groq_tokens(response):
+    """Yields the content deltas of a streamed completion as they arrive.
+    Chunks that are not the expected JSON are logged and skipped."""
+    try:
+        for line in response.iter_lines():
+            if not line.startswith(b'data:'):
+                continue
+            data = line[5:].strip()
+            if data == b'[DONE]':
+                break
+            try:
+                choice = (json.loads(data).get('choices') or [{}])[0]
+                token = choice.get('delta', {}).get('content')
+            except (ValueError, AttributeError, IndexError, KeyError, TypeError):
+                logger.warning(f'Skipping undecodable Groq stream chunk: {data[:200]!r}')
+                continue
+            if token and isinstance(token, str):
+                yield token
+    finally:
+        response.close()
+
+def relay_ai_stream(tokens):
+    """Server-sent events: one {"token"} per delta, then {"done", "content"}."""
+    parts = []
+    try:
+        for token in tokens:
+            parts.append(token)
+            yield f'data: {json.dumps({"token": token})}\n\n'
+        yield f'data: {json.dumps({"done": True, "content": "".join(parts)})}\n\n'
+    except requests.exceptions.RequestException as e:
+        logger.error(f'Groq API Stream Error: {str(e)}')
+        yield f'event: error\ndata: {json.dumps({"error": "AI stream interrupted"})}\n\n'
+
+def unbuffered_writes(wsgi_app):
+    """eventlet.wsgi holds chunks back until 4 KiB have piled up, which would
+    deliver a streamed answer in one piece at the end. Everything else this
+    app streams is written in blocks larger than that anyway. Installed
+    outside Flask-SocketIO's middleware, which hands Flask a copy of environ."""
+    def middleware(environ, start_response):
+        environ['eventlet.minimum_write_chunk_size'] = 0
+        return wsgi_app(environ, start_response)
+    return middleware
+
+app.wsgi_app = unbuffered_writes(app.wsgi_app)
 
 @app.route('/api/ai/chat', methods=['POST'])
 def ai_chat():
+    limited = rate_limited_response('ai_chat')
+    if limited:
+        return limited
     try:
         data = request.get_json()
         messages = data.get('messages', [])
@@ -914,35 +4065,28 @@ def ai_chat():
         if not messages:
             return jsonify({'error': 'Messages are required'}), 400
         
-        headers = {
-            'Authorization': f'Bearer {GROQ_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        payload = {
-            'model': 'llama-3.1-8b-instant',
-            'messages': messages,
-            'temperature': 0.7,
-            'max_tokens': 2000,
-        }
-        
-        response = requests.post(
-            f'{GROQ_API_URL}/chat/completions',
-            json=payload,
-            headers=headers,
-            timeout=30
-        )
-        
-        if response.status_code != 200:
-            logger.error(f'Groq API Error: {response.status_code} - {response.text}')
-            return jsonify({'error': f'AI API Error: {response.status_code}'}), 500
+        if data.get('stream'):
+            tokens = groq_token_stream(messages, request.remote_addr)
+            response = Response(
+                relay_ai_stream(tokens),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+            response.call_on_close(tokens.close)
+            return response
         
-        result = response.json()
         return jsonify({
             'success': True,
-            'content': result.get('choices', [{}])[0].get('message', {}).get('content', 'No response')
+            'content': groq_complete(messages, request.remote_addr)
         }), 200
         
+    except AIOverloaded as e:
+        response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    except AIUpstreamError as e:
+        return jsonify({'error': str(e)}), 500
     except requests.exceptions.Timeout:
         logger.error('Groq API Timeout')
         return jsonify({'error': 'AI request timeout'}), 504
@@ -953,48 +4097,191 @@ def ai_chat():
         logger.error(f'AI Chat Error: {str(e)}')
         return jsonify({'error': str(e)}), 500
 
+@socket_event('ai_chat')
+def handle_ai_chat(data):
+    if socket_rate_limited('ai_chat'): return
+    data = data if isinstance(data, dict) else {}
+    request_id = data.get('request_id')
+    messages = data.get('messages') or []
+    if not messages:
+        emit('ai_error', {'request_id': request_id, 'error': 'Messages are required'})
+        return
+
+    parts = []
+    tokens = None
+    try:
+        tokens = groq_token_stream(messages, request.remote_addr)
+        for token in tokens:
+            parts.append(token)
+            emit('ai_token', {'request_id': request_id, 'token': token})
+        emit('ai_done', {'request_id': request_id, 'content': ''.join(parts)})
+    except AIOverloaded as e:
+        emit('ai_error', {'request_id': request_id, 'error': str(e), 'retry_after': e.retry_after})
+    except AIUpstreamError as e:
+        emit('ai_error', {'request_id': request_id, 'error': str(e)})
+    except requests.exceptions.Timeout:
+        logger.error('Groq API Timeout')
+        emit('ai_error', {'request_id': request_id, 'error': 'AI request timeout'})
+    except requests.exceptions.RequestException as e:
+        logger.error(f'Groq API Request Error: {str(e)}')
+        emit('ai_error', {'request_id': request_id, 'error': 'AI connection error'})
+    finally:
+        if tokens is not None:
+            tokens.close()
+
 # --- CHAT EVENTS ---
 @socketio.on('connect')
 def handle_connect():
+    SOCKETS_CONNECTED.inc()
     logger.info(f'>>> SOCKET CONNECT: {request.sid}')
 
-@socketio.on('join_chat')
-def handle_join(data):
-    username = data.get('username', 'User').strip()
-    users[request.sid] = username
-    
-    # Broadcast to others
-    msg = serialize_message('System', f'{username} joined')
-    messages_history.append(msg)
-    socketio.emit('user_joined', {'user': username, 'users_list': list(users.values()), 'message': msg})
-    
-    # Send response to joiner
+def requested_room(data):
+    name = (data.get('room') or DEFAULT_ROOM) if isinstance(data, dict) else DEFAULT_ROOM
+    return name if isinstance(name, str) and ROOM_NAME_PATTERN.fullmatch(name) else None
+
+def message_room(name, sid):
+    """The sub-room a member receives chat messages through when batching is
+    enabled: <room>:batch for clients that asked for new_messages arrays,
+    <room>:single for the rest."""
+    return f"{name}:{'batch' if sid in batch_clients else 'single'}"
+
+def presence_room(name, sid):
+    """The sub-room a member receives presence through: <room>:presence for
+    clients that asked for presence_update, <room>:legacy for the rest."""
+    return f"{name}:{'presence' if sid in presence_clients else 'legacy'}"
+
+def enter_room(name):
+    sid, username = request.sid, users[request.sid]
+    room = get_room(name, create=True)
+    if room is None:
+        emit('chat_error', {'room': name, 'error': f'Room limit reached ({MAX_ROOMS})'})
+        return
+
+    if sid not in room.members:
+        version = room.add_member(sid, username)
+        user_rooms.setdefault(sid, set()).add(name)
+        join_room(name)
+        join_room(presence_room(name, sid))
+        if MESSAGE_BATCH_MS > 0:
+            join_room(message_room(name, sid))
+        msg = room.record(serialize_message('System', f'{username} joined', name))
+        room.queue_presence({'version': version, 'joined': username}, msg)
+
+    users_list, version = room.presence_snapshot()
     emit('joined_response', {
+        'room': name,
         'username': username,
-        'users_list': list(users.values()),
-        'messages': messages_history[-30:]
+        'users_list': users_list,
+        'presence_version': version,
+        'batch': MESSAGE_BATCH_MS > 0 and sid in batch_clients,
+        'presence_updates': sid in presence_clients,
+        'messages': room.tail(JOIN_HISTORY)
     })
 
-@socketio.on('send_message')
+def exit_room(sid, name):
+    room = rooms.get(name)
+    if room is None or sid not in room.members: return
+    user, version = room.remove_member(sid)
+    user_rooms.get(sid, set()).discard(name)
+    leave_room(name, sid=sid)
+    leave_room(presence_room(name, sid), sid=sid)
+    if MESSAGE_BATCH_MS > 0:
+        leave_room(message_room(name, sid), sid=sid)
+
+    msg = room.record(serialize_message('System', f'{user} left', name))
+    room.queue_presence({'version': version, 'left': user}, msg)
+    release_room(room)
+
+def member_room(data):
+    """The room named in an event if the sender is in it, else None."""
+    name = requested_room(data)
+    room = rooms.get(name)
+    if room is None or request.sid not in room.members:
+        emit('chat_error', {'room': name, 'error': 'Not in room'})
+        return None
+    return room
+
+@socket_event('join_chat')
+def handle_join(data):
+    if socket_rate_limited('join'): return
+    username = data.get('username', 'User').strip()
+    users[request.sid] = username
+    if data.get('batch'):
+        batch_clients.add(request.sid)
+    if data.get('presence_updates'):
+        presence_clients.add(request.sid)
+    name = requested_room(data)
+    if name is None:
+        emit('chat_error', {'error': 'Invalid room name'})
+        return
+    enter_room(name)
+
+@socket_event('join_room')
+def handle_join_room(data):
+    if request.sid not in users: return
+    if socket_rate_limited('join'): return
+    name = requested_room(data)
+    if name is None:
+        emit('chat_error', {'error': 'Invalid room name'})
+        return
+    enter_room(name)
+
+@socket_event('leave_room')
+def handle_leave_room(data):
+    if request.sid not in users: return
+    room = member_room(data)
+    if room is None: return
+    exit_room(request.sid, room.name)
+    emit('left_room', {'room': room.name})
+
+@socket_event('resync_presence')
+def handle_resync_presence(data):
+    if request.sid not in users: return
+    room = member_room(data)
+    if room is None: return
+    users_list, version = room.presence_snapshot()
+    emit('presence_snapshot', {'room': room.name, 'users_list': users_list, 'presence_version': version})
+
+@socket_event('fetch_history')
+def handle_fetch_history(data):
+    if request.sid not in users: return
+    room = member_room(data)
+    if room is None: return
+    data = data if isinstance(data, dict) else {}
+    try:
+        before_id = int(data.get('before_id') or 0)
+        limit = int(data.get('limit') or FETCH_HISTORY_LIMIT)
+    except (TypeError, ValueError):
+        emit('history', {'room': room.name, 'error': 'before_id and limit must be integers'})
+        return
+    limit = min(max(limit, 1), FETCH_HISTORY_LIMIT)
+
+    page, has_more = room.history_before(before_id, limit)
+    emit('history', {'room': room.name, 'messages': page, 'has_more': has_more})
+
+@socket_event('send_message')
 def handle_message(data):
     if request.sid not in users: return
+    if socket_rate_limited('send_message'): return
     username = users[request.sid]
     content = data.get('message', '').strip()
     if not content: return
+    room = member_room(data)
+    if room is None: return
     
-    msg = serialize_message(username, content)
-    messages_history.append(msg)
-    if len(messages_history) > MAX_HISTORY: messages_history.pop(0)
+    msg = room.record(serialize_message(username, content, room.name))
     
-    socketio.emit('new_message', msg)
+    room.broadcast(msg)
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    SOCKETS_CONNECTED.dec()
     if request.sid in users:
-        user = users.pop(request.sid)
-        msg = serialize_message('System', f'{user} left')
-        messages_history.append(msg)
-        socketio.emit('user_left', {'user': user, 'users_list': list(users.values())})
+        users.pop(request.sid)
+        for name in user_rooms.pop(request.sid, set()):
+            exit_room(request.sid, name)
+        batch_clients.discard(request.sid)
+        presence_clients.discard(request.sid)
 
 if __name__ == '__main__':
     logger.info(f'--- SERVIDOR INICIADO EN PUERTO {PORT} ---')
@@ -0,0 +1,102 @@
+"""AI scenario: /api/ai/chat against bench/mock_groq.py. Distinct prompts go
+upstream through the admission queue, repeated prompts exercise the answer
+cache, and streamed requests report time to first token."""
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+from common import Server, free_port, summarize
+
+MOCK_GROQ_PATH = Path(__file__).resolve().parent / 'mock_groq.py'
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group('ai')
+    group.add_argument('--ai-requests', type=int, default=200)
+    group.add_argument('--ai-concurrency', type=int, default=16)
+    group.add_argument('--mock-delay-ms', type=float, default=200)
+    group.add_argument('--mock-tokens', type=int, default=20)
+    group.add_argument('--mock-token-interval-ms', type=float, default=10)
+
+
+def start_mock_groq(args):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, str(MOCK_GROQ_PATH), '--port', str(port),
+         '--delay-ms', str(args.mock_delay_ms), '--tokens', str(args.mock_tokens),
+         '--token-interval-ms', str(args.mock_token_interval_ms)],
+        stdout=subprocess.DEVNULL
+    )
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            requests.get(f'{url}/stats', timeout=1)
+            return process, url
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('mock Groq server did not start')
+
+
+def ask(url, prompt, stream):
+    """Returns (status, seconds to first token, seconds to the whole answer)."""
+    started = time.perf_counter()
+    response = requests.post(
+        f'{url}/api/ai/chat',
+        json={'messages': [{'role': 'user', 'content': prompt}], 'stream': stream},
+        stream=stream,
+        timeout=120
+    )
+    first_token = None
+    with response:
+        if stream and response.status_code == 200:
+            for line in response.iter_lines():
+                if line.startswith(b'data:') and first_token is None:
+                    first_token = time.perf_counter() - started
+        else:
+            response.content
+    return response.status_code, first_token, time.perf_counter() - started
+
+
+def run_phase(server, mock_url, prompts, stream, concurrency):
+    calls_before = requests.get(f'{mock_url}/stats', timeout=5).json()['calls']
+    with server.measure() as usage:
+        with ThreadPoolExecutor(concurrency) as pool:
+            outcomes = list(pool.map(lambda prompt: ask(server.url, prompt, stream), prompts))
+    calls = requests.get(f'{mock_url}/stats', timeout=5).json()['calls'] - calls_before
+
+    statuses = {}
+    for status, _, _ in outcomes:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = [outcome for outcome in outcomes if outcome[0] == 200]
+    result = {
+        'latency': summarize([seconds for _, _, seconds in ok]),
+        'statuses': statuses,
+        'errors': len(outcomes) - len(ok),
+        'upstream_calls': calls,
+        'requests_per_s': round(len(ok) / usage['seconds'], 1) if usage['seconds'] else None,
+        'server': usage
+    }
+    if stream:
+        result['first_token'] = summarize([first for _, first, _ in ok if first is not None])
+    return result
+
+
+def run(args, env):
+    mock, mock_url = start_mock_groq(args)
+    try:
+        with Server(dict(env, GROQ_API_URL=mock_url)) as server:
+            count = args.ai_requests
+            return {
+                'unique': run_phase(server, mock_url, [f'unique {i}' for i in range(count)], False, args.ai_concurrency),
+                'repeated': run_phase(server, mock_url, [f'repeated {i % 10}' for i in range(count)], False, args.ai_concurrency),
+                'stream': run_phase(server, mock_url, [f'stream {i}' for i in range(count)], True, args.ai_concurrency)
+            }
+    finally:
+        mock.terminate()
+        mock.wait(10)
@@ -0,0 +1,280 @@
+"""Chat scenario: a join storm of --clients Socket.IO clients into one room,
+--senders of them sending --messages each while everyone receives, then all
+of them disconnecting at once.
+
+Clients are green threads spread over --client-procs worker processes, each
+running this file. The run steers them with one-line JSON commands on stdin
+and reads one-line JSON replies from stdout. Send and receive times come
+from time.perf_counter(), which on Linux is the system-wide CLOCK_MONOTONIC,
+so latencies can be compared across the workers. Needs websocket-client
+(pip install websocket-client).
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+import requests
+
+from common import Server, summarize
+
+MESSAGE_TAG = 'bench '
+DELIVERY_TIMEOUT = 30
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group('chat')
+    group.add_argument('--clients', type=int, default=500)
+    group.add_argument('--client-procs', type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                       help='load generator processes')
+    group.add_argument('--senders', type=int, default=10)
+    group.add_argument('--messages', type=int, default=20, help='messages per sender')
+    group.add_argument('--send-interval-ms', type=float, default=50)
+    group.add_argument('--connect-concurrency', type=int, default=100, help='per process')
+    group.add_argument('--room', default='bench')
+    group.add_argument('--batch', action='store_true',
+                       help='join with batch=true; pair with --env MESSAGE_BATCH_MS=...')
+
+
+def split(total, parts):
+    return [total // parts + (index < total % parts) for index in range(parts)]
+
+
+class Worker:
+    """One load generator process and its share of the clients."""
+
+    def __init__(self, url, args, first, count):
+        config = {
+            'url': url, 'room': args.room, 'batch': args.batch, 'first': first,
+            'count': count, 'connect_concurrency': args.connect_concurrency
+        }
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), json.dumps(config)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True
+        )
+
+    def command(self, name, **params):
+        self.process.stdin.write(json.dumps({'command': name, **params}) + '\n')
+        self.process.stdin.flush()
+
+    def reply(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError('chat load worker exited')
+        return json.loads(line)
+
+    def close(self):
+        self.process.stdin.close()
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def broadcast(workers, name, **params):
+    for worker in workers:
+        worker.command(name, **params)
+    return [worker.reply() for worker in workers]
+
+
+def run(args, env):
+    shares = split(args.clients, max(1, min(args.client_procs, args.clients)))
+    result = {'clients': args.clients, 'client_procs': len(shares)}
+
+    with Server(env) as server:
+        workers = []
+        try:
+            with server.measure() as usage:
+                first = 0
+                for count in shares:
+                    workers.append(Worker(server.url, args, first, count))
+                    first += count
+                server.client_pids = [worker.process.pid for worker in workers]
+                join_times = [seconds for worker in workers for seconds in worker.reply()['join_times']]
+            joined = len(join_times)
+            result['join'] = {**summarize(join_times), 'errors': args.clients - joined, 'server': usage}
+
+            # Let the presence batches of the join storm drain first.
+            time.sleep(1)
+            senders = [min(count, share) for count, share in zip(split(args.senders, len(shares)), shares)]
+            expected = sum(senders) * args.messages * joined
+            with server.measure() as usage:
+                started = time.perf_counter()
+                for worker, count in zip(workers, senders):
+                    worker.command('send', senders=count, messages=args.messages,
+                                   interval=args.send_interval_ms / 1000)
+                for worker in workers:
+                    worker.reply()
+                deadline = time.perf_counter() + DELIVERY_TIMEOUT
+                while time.perf_counter() < deadline:
+                    if sum(reply['deliveries'] for reply in broadcast(workers, 'count')) >= expected:
+                        break
+                    time.sleep(0.2)
+            reports = broadcast(workers, 'report')
+            latencies = [seconds for report in reports for seconds in report['latencies']]
+            last_received = max(report['last_received'] or started for report in reports)
+            elapsed = last_received - started
+            result['fanout'] = {
+                'sent': sum(senders) * args.messages,
+                'expected_deliveries': expected,
+                'deliveries': len(latencies),
+                'messages_per_s': round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+                'latency': summarize(latencies),
+                'server': usage
+            }
+
+            with server.measure() as usage:
+                disconnects = broadcast(workers, 'disconnect')
+                started = time.perf_counter()
+                requests.get(f'{server.url}/health', timeout=30)
+                health_seconds = time.perf_counter() - started
+            result['disconnect'] = {
+                **summarize([seconds for reply in disconnects for seconds in reply['disconnect_times']]),
+                # Connections the server closed before the storm, e.g. missed pings.
+                'dropped_before': sum(reply['dropped'] for reply in disconnects),
+                'health_after_ms': round(health_seconds * 1000, 2),
+                'server': usage
+            }
+        finally:
+            for worker in workers:
+                worker.close()
+    return result
+
+
+def worker_main(config):
+    """A load generator process: joins its clients, then follows commands."""
+    import eventlet
+    import eventlet.tpool
+    eventlet.monkey_patch()
+    import websocket
+
+    latencies = []
+    received = {'last': None}
+    dropped = []
+
+    def record(msg):
+        content = msg.get('content', '') if isinstance(msg, dict) else ''
+        if content.startswith(MESSAGE_TAG):
+            now = time.perf_counter()
+            latencies.append(now - float(content[len(MESSAGE_TAG):]))
+            received['last'] = now
+
+    class ChatClient:
+        """Speaks just enough Engine.IO 4 / Socket.IO 5 over a websocket for
+        the chat events. socketio.Client runs several threads per connection,
+        which would make the load generator the bottleneck long before the
+        server."""
+
+        def __init__(self):
+            self.ws = None
+            self.closing = False
+
+        def emit(self, event, data):
+            self.ws.send('42' + json.dumps([event, data]))
+
+        def receive(self):
+            """The next Socket.IO event packet, answering pings on the way.
+            Raises on a closed connection."""
+            while True:
+                packet = self.ws.recv()
+                if packet == '2':
+                    self.ws.send('3')
+                elif packet.startswith('42'):
+                    return packet
+                elif packet.startswith('41') or not packet:
+                    raise ConnectionError('disconnected by server')
+
+        def join(self, username):
+            started = time.perf_counter()
+            self.ws = websocket.create_connection(
+                config['url'].replace('http', 'ws', 1) + '/socket.io/?EIO=4&transport=websocket',
+                timeout=30
+            )
+            self.ws.recv()
+            self.ws.send('40')
+            if not self.ws.recv().startswith('40'):
+                raise ConnectionError('namespace connect refused')
+            self.emit('join_chat', {
+                'username': username, 'room': config['room'], 'batch': config['batch'], 'presence_updates': True
+            })
+            while not self.receive().startswith('42["joined_response"'):
+                pass
+            elapsed = time.perf_counter() - started
+            self.ws.settimeout(None)
+            eventlet.spawn_n(self.read_forever)
+            return elapsed
+
+        def read_forever(self):
+            # Only message events are decoded; every client also gets a
+            # presence_update per join or leave batch, which is not measured.
+            try:
+                while True:
+                    packet = self.receive()
+                    if packet.startswith('42["new_message",'):
+                        record(json.loads(packet[2:])[1])
+                    elif packet.startswith('42["new_messages",'):
+                        for msg in json.loads(packet[2:])[1].get('messages', []):
+                            record(msg)
+            except Exception:
+                if not self.closing:
+                    dropped.append(self)
+
+        def send(self, count, interval):
+            for _ in range(count):
+                self.emit('send_message', {'room': config['room'], 'message': f'{MESSAGE_TAG}{time.perf_counter()!r}'})
+                time.sleep(interval)
+
+        def disconnect(self):
+            started = time.perf_counter()
+            self.closing = True
+            try:
+                self.ws.send('41')
+            except OSError:
+                pass
+            self.ws.shutdown()
+            return time.perf_counter() - started
+
+    def join(index):
+        client = ChatClient()
+        try:
+            return client, client.join(f"bench{config['first'] + index}")
+        except Exception:
+            return client, None
+
+    def reply(message):
+        sys.stdout.write(json.dumps(message) + '\n')
+        sys.stdout.flush()
+
+    pool = eventlet.GreenPool(config['connect_concurrency'])
+    outcomes = list(pool.imap(join, range(config['count'])))
+    clients = [client for client, seconds in outcomes if seconds is not None]
+    reply({'join_times': [seconds for _, seconds in outcomes if seconds is not None]})
+
+    # A plain stdin read would block the hub, and with it every client's
+    # pings and reads, while waiting for the next command.
+    for line in iter(lambda: eventlet.tpool.execute(sys.stdin.readline), ''):
+        message = json.loads(line)
+        command = message['command']
+        if command == 'send':
+            senders = eventlet.GreenPool(max(1, message['senders']))
+            for client in clients[:message['senders']]:
+                senders.spawn(client.send, message['messages'], message['interval'])
+            senders.waitall()
+            reply({})
+        elif command == 'count':
+            reply({'deliveries': len(latencies)})
+        elif command == 'report':
+            reply({'latencies': latencies, 'last_received': received['last']})
+        elif command == 'disconnect':
+            reply({
+                'disconnect_times': list(pool.imap(ChatClient.disconnect, clients)),
+                'dropped': len(dropped)
+            })
+
+
+if __name__ == '__main__':
+    worker_main(json.loads(sys.argv[1]))
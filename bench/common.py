@@ -0,0 +1,161 @@
+"""Shared pieces of the benchmark suite: app.py in a scratch directory, its
+CPU and memory read from /proc (so Linux only), and latency summaries."""
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import requests
+
+APP_PATH = Path(__file__).resolve().parent.parent / 'app.py'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+# Every simulated client comes from this host, so per-IP limits would
+# throttle the load instead of measuring it.
+BENCH_ENV = {
+    'RATE_LIMIT_JOIN_PER_SID': '0',
+    'RATE_LIMIT_JOIN_PER_IP': '0',
+    'RATE_LIMIT_MESSAGE_PER_SID': '0',
+    'RATE_LIMIT_MESSAGE_PER_IP': '0',
+    'RATE_LIMIT_UPLOAD_PER_IP': '0',
+    'RATE_LIMIT_AI_PER_IP': '0',
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def raise_file_limit():
+    """Thousands of sockets need more than the usual 1024 descriptors, here
+    and in the server started from here."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def process_cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def process_memory_mb(pid):
+    """Current and peak resident set size."""
+    memory = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ('VmRSS', 'VmHWM'):
+                memory[name] = int(value.split()[0]) / 1024
+    return memory.get('VmRSS', 0), memory.get('VmHWM', 0)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(seconds):
+    """Count and p50/p99/max/mean in milliseconds of a list of durations."""
+    ordered = sorted(seconds)
+    if not ordered:
+        return {'count': 0}
+    return {
+        'count': len(ordered),
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 2),
+        'max_ms': round(ordered[-1] * 1000, 2),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 2)
+    }
+
+
+class Server:
+    """app.py on a free port in a scratch directory, with BENCH_ENV and
+    `env` on top of the current environment."""
+
+    def __init__(self, env=None):
+        self.env = dict(os.environ, **BENCH_ENV, **(env or {}))
+        self.port = free_port()
+        self.env['PORT'] = str(self.port)
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.workdir = None
+        self.process = None
+        # Load generator processes besides this one, counted as client CPU.
+        self.client_pids = []
+
+    def __enter__(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.process = subprocess.Popen(
+            [sys.executable, str(APP_PATH)],
+            cwd=self.workdir.name,
+            env=self.env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                requests.get(f'{self.url}/health', timeout=1)
+                return self
+            except requests.RequestException:
+                if self.process.poll() is not None:
+                    break
+                time.sleep(0.2)
+        self.__exit__(None, None, None)
+        raise RuntimeError(f'app.py did not start on port {self.port}')
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.workdir.cleanup()
+
+    def _client_cpu(self):
+        cpu = {None: time.process_time()}
+        for pid in self.client_pids:
+            try:
+                cpu[pid] = process_cpu_seconds(pid)
+            except OSError:
+                pass
+        return cpu
+
+    @contextmanager
+    def measure(self):
+        """Wall time, server and load generator CPU seconds, and the server's
+        RSS and peak RSS over the block, filled into the yielded dict on exit."""
+        usage = {}
+        try:
+            # Resets VmHWM so the peak belongs to this block.
+            with open(f'/proc/{self.process.pid}/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+        cpu_before = process_cpu_seconds(self.process.pid)
+        client_cpu_before = self._client_cpu()
+        started = time.perf_counter()
+        yield usage
+        rss, rss_peak = process_memory_mb(self.process.pid)
+        client_cpu = self._client_cpu()
+        usage.update({
+            'seconds': round(time.perf_counter() - started, 3),
+            'cpu_seconds': round(process_cpu_seconds(self.process.pid) - cpu_before, 3),
+            # Near `seconds` times the number of load generator processes,
+            # the load generator itself was the bottleneck.
+            'client_cpu_seconds': round(sum(
+                seconds - client_cpu_before.get(pid, 0) for pid, seconds in client_cpu.items()
+            ), 3),
+            'rss_mb': round(rss, 1),
+            'rss_peak_mb': round(rss_peak, 1)
+        })
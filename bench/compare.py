@@ -0,0 +1,76 @@
+"""Compare two bench/run.py result files, e.g. from before and after a change.
+
+    python bench/compare.py before.json after.json --threshold 10
+
+Prints every numeric result side by side with its change. Changes for the
+worse beyond --threshold percent are marked; latencies, CPU, memory and
+errors are better lower, throughput and rates better higher. Exits with 1
+when any are marked and --fail is given.
+"""
+import argparse
+import json
+
+LOWER_IS_BETTER = ('_ms', '_seconds', '_mb', '_per_gb', 'errors')
+HIGHER_IS_BETTER = ('_per_s', '_mb_s')
+
+
+def flatten(value, prefix=''):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, f'{prefix}.{key}' if prefix else key)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def direction(metric):
+    """-1 when lower is better, 1 when higher is better, 0 when neither."""
+    name = metric.rsplit('.', 1)[-1]
+    if name.endswith(HIGHER_IS_BETTER):
+        return 1
+    if name.endswith(LOWER_IS_BETTER):
+        return -1
+    return 0
+
+
+def load_results(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report.get('meta', {}), dict(flatten(report.get('results', {})))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=10, help='percent')
+    parser.add_argument('--fail', action='store_true', help='exit 1 on marked regressions')
+    args = parser.parse_args()
+
+    baseline_meta, baseline = load_results(args.baseline)
+    current_meta, current = load_results(args.current)
+    print(f"baseline {baseline_meta.get('revision')}  current {current_meta.get('revision')}")
+
+    width = max((len(metric) for metric in baseline.keys() | current.keys()), default=10)
+    regressions = 0
+    for metric in sorted(baseline.keys() | current.keys()):
+        before, after = baseline.get(metric), current.get(metric)
+        change = ''
+        mark = ''
+        if before is not None and after is not None:
+            if before:
+                percent = (after - before) / abs(before) * 100
+                change = f'{percent:+.1f}%'
+                if direction(metric) * percent < -args.threshold:
+                    mark = '  <-- worse'
+                    regressions += 1
+            elif after:
+                change = 'new'
+        print(f'{metric:<{width}}  {str(before):>12}  {str(after):>12}  {change:>8}{mark}')
+
+    print(f'{regressions} regression(s) beyond {args.threshold:g}%')
+    if args.fail and regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
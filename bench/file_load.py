@@ -0,0 +1,160 @@
+"""Files scenario: concurrent multipart uploads, then parallel full and
+byte-range downloads of one file for each DOWNLOAD_MODE in --modes, with
+throughput and server CPU seconds per GB served.
+
+x-accel and x-sendfile hand the bytes to a fronting web server, so they are
+not measured here; benchmark them through that server instead.
+"""
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from common import Server, summarize
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group('files')
+    group.add_argument('--uploads', type=int, default=200)
+    group.add_argument('--upload-size-kb', type=int, default=256)
+    group.add_argument('--upload-concurrency', type=int, default=8)
+    group.add_argument('--size-mb', type=int, default=10, help='size of the downloaded file, at most 12 (single upload limit)')
+    group.add_argument('--downloads', type=int, default=100)
+    group.add_argument('--range-downloads', type=int, default=500)
+    group.add_argument('--range-kb', type=int, default=64)
+    group.add_argument('--download-concurrency', type=int, default=8)
+    group.add_argument('--modes', default='stream', help='comma-separated DOWNLOAD_MODE values')
+
+
+class SourceAddressAdapter(requests.adapters.HTTPAdapter):
+    """Connects from a given local address. The app allows each client IP
+    only a few files, so every upload worker gets its own 127.0.0.x."""
+
+    def __init__(self, source_address, **kwargs):
+        self.source_address = source_address
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['source_address'] = (self.source_address, 0)
+        super().init_poolmanager(*args, **kwargs)
+
+
+def upload_worker(base_url, worker, count, size):
+    """Uploads and deletes `count` files, returning the upload latencies and
+    the number of failed requests."""
+    session = requests.Session()
+    session.mount('http://', SourceAddressAdapter(f'127.0.0.{worker + 2}'))
+    latencies = []
+    errors = 0
+    for index in range(count):
+        payload = os.urandom(size)
+        started = time.perf_counter()
+        response = session.post(
+            f'{base_url}/api/files/upload',
+            files={'file': (f'bench{worker}-{index}.zip', payload)},
+            timeout=60
+        )
+        if response.status_code != 201:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+        if session.delete(f"{base_url}/api/files/{response.json()['file_id']}", timeout=60).status_code != 200:
+            errors += 1
+    return latencies, errors
+
+
+def run_uploads(args, env):
+    per_worker = [args.uploads // args.upload_concurrency] * args.upload_concurrency
+    for index in range(args.uploads % args.upload_concurrency):
+        per_worker[index] += 1
+    size = args.upload_size_kb * 1024
+
+    with Server(env) as server:
+        with server.measure() as usage:
+            with ThreadPoolExecutor(args.upload_concurrency) as pool:
+                outcomes = list(pool.map(
+                    lambda item: upload_worker(server.url, item[0], item[1], size),
+                    enumerate(per_worker)
+                ))
+    latencies = [seconds for worker_latencies, _ in outcomes for seconds in worker_latencies]
+    total_bytes = len(latencies) * size
+    return {
+        **summarize(latencies),
+        'errors': sum(errors for _, errors in outcomes),
+        'throughput_mb_s': round(total_bytes / 1024 ** 2 / usage['seconds'], 1) if usage['seconds'] else None,
+        'server': usage
+    }
+
+
+def download(session, url, headers=None):
+    started = time.perf_counter()
+    received = 0
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(256 * 1024):
+            received += len(chunk)
+    return time.perf_counter() - started, received
+
+
+def timed_downloads(url, jobs, concurrency):
+    """Runs downloads with the given Range headers (None for the whole file)
+    from `concurrency` threads, each with its own keep-alive session."""
+    local = threading.local()
+
+    def fetch(headers):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return download(local.session, url, headers)
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(fetch, jobs))
+
+
+def summarize_downloads(outcomes, usage):
+    total_bytes = sum(received for _, received in outcomes)
+    gigabytes = total_bytes / 1024 ** 3
+    return {
+        **summarize([seconds for seconds, _ in outcomes]),
+        'bytes': total_bytes,
+        'throughput_mb_s': round(total_bytes / 1024 ** 2 / usage['seconds'], 1) if usage['seconds'] else None,
+        'cpu_seconds_per_gb': round(usage['cpu_seconds'] / gigabytes, 3) if gigabytes else None,
+        'server': usage
+    }
+
+
+def run_downloads(args, env, mode):
+    size = args.size_mb * 1024 * 1024
+    range_size = args.range_kb * 1024
+    with Server(dict(env, DOWNLOAD_MODE=mode)) as server:
+        response = requests.post(
+            f'{server.url}/api/files/upload',
+            files={'file': ('bench.zip', os.urandom(size))},
+            timeout=60
+        )
+        response.raise_for_status()
+        url = f"{server.url}/api/files/download/{response.json()['file_id']}"
+        download(requests.Session(), url)
+
+        with server.measure() as usage:
+            full = timed_downloads(url, [None] * args.downloads, args.download_concurrency)
+        result = {'full': summarize_downloads(full, usage)}
+
+        rng = random.Random(0)
+        ranges = []
+        for _ in range(args.range_downloads):
+            start = rng.randrange(0, max(1, size - range_size))
+            ranges.append({'Range': f'bytes={start}-{start + range_size - 1}'})
+        with server.measure() as usage:
+            partial = timed_downloads(url, ranges, args.download_concurrency)
+        result['ranges'] = summarize_downloads(partial, usage)
+    return result
+
+
+def run(args, env):
+    return {
+        'uploads': run_uploads(args, env),
+        'downloads': {mode: run_downloads(args, env, mode) for mode in args.modes.split(',')}
+    }
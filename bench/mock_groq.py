@@ -0,0 +1,98 @@
+"""Local stand-in for the Groq chat completions API, so AI benchmarks measure
+the app and not the network or a paid quota.
+
+    python bench/mock_groq.py --port 6400 --delay-ms 200 --tokens 20 --token-interval-ms 10
+    GROQ_API_URL=http://127.0.0.1:6400 python app.py
+
+Answers POST .../chat/completions after --delay-ms, either as one JSON body
+or, with "stream": true, as --tokens server-sent events. GET /stats returns
+the number of completions served.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockGroqHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    settings = None
+    calls = 0
+    calls_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.send_json(404, {'error': 'not found'})
+        self.send_json(200, {'calls': MockGroqHandler.calls})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.endswith('/chat/completions'):
+            return self.send_json(404, {'error': 'not found'})
+        with MockGroqHandler.calls_lock:
+            MockGroqHandler.calls += 1
+
+        settings = self.settings
+        time.sleep(settings.delay_ms / 1000)
+        words = [f'tok{index} ' for index in range(settings.tokens)]
+        if not body.get('stream'):
+            return self.send_json(200, {'choices': [{'message': {'role': 'assistant', 'content': ''.join(words)}}]})
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for word in words:
+            event = {'choices': [{'delta': {'content': word}}]}
+            self.send_chunk(f'data: {json.dumps(event)}\n\n'.encode())
+            time.sleep(settings.token_interval_ms / 1000)
+        self.send_chunk(b'data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class MockGroqServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The app's keep-alive pool drops idle connections; not worth a traceback.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6400)
+    parser.add_argument('--delay-ms', type=float, default=200)
+    parser.add_argument('--tokens', type=int, default=20)
+    parser.add_argument('--token-interval-ms', type=float, default=10)
+    args = parser.parse_args()
+
+    MockGroqHandler.settings = args
+    server = MockGroqServer((args.host, args.port), MockGroqHandler)
+    print(f'Mock Groq listening on {args.host}:{args.port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+"""In-memory stand-in for Redis, for running several chat workers locally.
+
+Speaks enough of the Redis protocol (RESP2) for the Socket.IO message queue
+(PUBLISH/SUBSCRIBE) and the shared chat store (strings, hashes, sets, sorted
+sets and MULTI/EXEC). Nothing is persisted. Use a real Redis in production.
+
+    python bench/resp_broker.py --port 6399
+    SOCKETIO_MESSAGE_QUEUE='redis://127.0.0.1:6399/0?protocol=2' PORT=5625 python app.py
+    SOCKETIO_MESSAGE_QUEUE='redis://127.0.0.1:6399/0?protocol=2' PORT=5626 python app.py
+
+HELLO/RESP3 is not implemented, hence protocol=2 for redis-py 6 and later.
+"""
+import argparse
+import asyncio
+import bisect
+import time
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class CommandError(Exception):
+    pass
+
+
+def encode(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, bool):
+        return b':%d\r\n' % int(value)
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, CommandError):
+        return b'-ERR %s\r\n' % str(value).encode()
+    if isinstance(value, str):
+        return b'+%s\r\n' % value.encode()
+    if isinstance(value, (bytes, float)):
+        data = value if isinstance(value, bytes) else repr(value).encode()
+        return b'$%d\r\n%s\r\n' % (len(data), data)
+    return b'*%d\r\n' % len(value) + b''.join(encode(item) for item in value)
+
+
+def parse_score(raw):
+    raw = raw.decode()
+    exclusive = raw.startswith('(')
+    raw = raw.lstrip('(')
+    if raw in ('+inf', 'inf'):
+        return float('inf'), exclusive
+    if raw == '-inf':
+        return float('-inf'), exclusive
+    return float(raw), exclusive
+
+
+def format_score(score):
+    return b'%d' % score if score == int(score) else repr(score).encode()
+
+
+class Store:
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.channels = {}
+
+    def _get(self, key, kind):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        value = self.data.get(key)
+        if value is not None and not isinstance(value, kind):
+            raise CommandError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def _get_or_create(self, key, kind):
+        value = self._get(key, kind)
+        if value is None:
+            value = self.data[key] = kind()
+        return value
+
+    def _ranked(self, key):
+        zset = self._get(key, ZSet)
+        return zset.ranked() if zset else []
+
+    # Connection
+    def cmd_ping(self, *args):
+        return args[0] if args else 'PONG'
+
+    def cmd_echo(self, message):
+        return message
+
+    def cmd_select(self, db):
+        return 'OK'
+
+    def cmd_client(self, *args):
+        return 'OK'
+
+    # Strings and keys
+    def cmd_get(self, key):
+        return self._get(key, bytes)
+
+    def cmd_set(self, key, value, *options):
+        self._get(key, object)
+        self.data[key] = value
+        self.expires.pop(key, None)
+        options = [option.upper() for option in options]
+        for flag in (b'EX', b'PX'):
+            if flag in options:
+                seconds = float(options[options.index(flag) + 1])
+                self.expires[key] = time.monotonic() + (seconds if flag == b'EX' else seconds / 1000)
+        return 'OK'
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, b'1')
+
+    def cmd_incrby(self, key, amount):
+        value = int(self._get(key, bytes) or 0) + int(amount)
+        self.data[key] = b'%d' % value
+        return value
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._get(key, object) is not None:
+                del self.data[key]
+                self.expires.pop(key, None)
+                removed += 1
+        return removed
+
+    def cmd_exists(self, *keys):
+        return sum(self._get(key, object) is not None for key in keys)
+
+    def cmd_expire(self, key, seconds):
+        if self._get(key, object) is None:
+            return 0
+        self.expires[key] = time.monotonic() + int(seconds)
+        return 1
+
+    # Hashes
+    def cmd_hset(self, key, *pairs):
+        mapping = self._get_or_create(key, dict)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in mapping
+            mapping[field] = value
+        return added
+
+    def cmd_hget(self, key, field):
+        return (self._get(key, dict) or {}).get(field)
+
+    def cmd_hdel(self, key, *fields):
+        mapping = self._get(key, dict) or {}
+        removed = sum(mapping.pop(field, None) is not None for field in fields)
+        if not mapping:
+            self.data.pop(key, None)
+        return removed
+
+    def cmd_hgetall(self, key):
+        return [item for pair in (self._get(key, dict) or {}).items() for item in pair]
+
+    def cmd_hvals(self, key):
+        return list((self._get(key, dict) or {}).values())
+
+    def cmd_hlen(self, key):
+        return len(self._get(key, dict) or {})
+
+    def cmd_hincrby(self, key, field, amount):
+        mapping = self._get_or_create(key, dict)
+        value = int(mapping.get(field, 0)) + int(amount)
+        mapping[field] = b'%d' % value
+        return value
+
+    # Sets
+    def cmd_sadd(self, key, *members):
+        members_set = self._get_or_create(key, set)
+        before = len(members_set)
+        members_set.update(members)
+        return len(members_set) - before
+
+    def cmd_srem(self, key, *members):
+        members_set = self._get(key, set) or set()
+        removed = sum(member in members_set for member in members)
+        members_set.difference_update(members)
+        if not members_set:
+            self.data.pop(key, None)
+        return removed
+
+    def cmd_smembers(self, key):
+        return list(self._get(key, set) or ())
+
+    # Sorted sets
+    def cmd_zadd(self, key, *pairs):
+        zset = self._get_or_create(key, ZSet)
+        return sum(zset.add(member, float(score)) for score, member in zip(pairs[::2], pairs[1::2]))
+
+    def cmd_zcard(self, key):
+        return len(self._ranked(key))
+
+    def cmd_zremrangebyrank(self, key, start, stop):
+        zset = self._get(key, ZSet)
+        if not zset:
+            return 0
+        doomed = zset.slice(int(start), int(stop))
+        for _, member in doomed:
+            zset.remove(member)
+        return len(doomed)
+
+    def cmd_zrange(self, key, start, stop, *options):
+        zset = self._get(key, ZSet)
+        rows = zset.slice(int(start), int(stop)) if zset else []
+        return self._rows(rows, options)
+
+    def cmd_zrangebyscore(self, key, low, high, *options):
+        return self._by_score(key, low, high, options, reverse=False)
+
+    def cmd_zrevrangebyscore(self, key, high, low, *options):
+        return self._by_score(key, low, high, options, reverse=True)
+
+    def _by_score(self, key, low, high, options, reverse):
+        low, low_open = parse_score(low)
+        high, high_open = parse_score(high)
+        rows = [
+            row for row in self._ranked(key)
+            if (low < row[0] if low_open else low <= row[0]) and (row[0] < high if high_open else row[0] <= high)
+        ]
+        if reverse:
+            rows.reverse()
+        upper = [option.upper() for option in options]
+        if b'LIMIT' in upper:
+            offset, count = (int(value) for value in options[upper.index(b'LIMIT') + 1:upper.index(b'LIMIT') + 3])
+            rows = rows[offset:] if count < 0 else rows[offset:offset + count]
+        return self._rows(rows, options)
+
+    @staticmethod
+    def _rows(rows, options):
+        if b'WITHSCORES' in [option.upper() for option in options]:
+            return [item for score, member in rows for item in (member, format_score(score))]
+        return [member for _, member in rows]
+
+
+class ZSet:
+    def __init__(self):
+        self.scores = {}
+        self.order = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, member, score):
+        added = member not in self.scores
+        if not added:
+            self.remove(member)
+        self.scores[member] = score
+        bisect.insort(self.order, (score, member))
+        return added
+
+    def remove(self, member):
+        score = self.scores.pop(member)
+        del self.order[bisect.bisect_left(self.order, (score, member))]
+
+    def ranked(self):
+        return list(self.order)
+
+    def slice(self, start, stop):
+        size = len(self.order)
+        start = max(start + size if start < 0 else start, 0)
+        stop = stop + size if stop < 0 else min(stop, size - 1)
+        return self.order[start:stop + 1] if start <= stop else []
+
+
+class Connection:
+    def __init__(self, store, reader, writer):
+        self.store = store
+        self.reader = reader
+        self.writer = writer
+        self.subscriptions = set()
+        self.transaction = None
+
+    async def read_command(self):
+        line = await self.reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            header = await self.reader.readline()
+            if not header.startswith(b'$'):
+                raise ProtocolError('expected bulk string')
+            args.append((await self.reader.readexactly(int(header[1:]) + 2))[:-2])
+        return args
+
+    def send(self, value):
+        self.writer.write(encode(value))
+
+    def subscribe(self, channels):
+        for channel in channels:
+            self.subscriptions.add(channel)
+            self.store.channels.setdefault(channel, set()).add(self)
+            self.send([b'subscribe', channel, len(self.subscriptions)])
+
+    def unsubscribe(self, channels):
+        for channel in channels or list(self.subscriptions):
+            self.subscriptions.discard(channel)
+            self.store.channels.get(channel, set()).discard(self)
+            self.send([b'unsubscribe', channel, len(self.subscriptions)])
+
+    def publish(self, channel, message):
+        subscribers = self.store.channels.get(channel, ())
+        for subscriber in subscribers:
+            subscriber.send([b'message', channel, message])
+        return len(subscribers)
+
+    def call(self, name, args):
+        handler = getattr(self.store, f'cmd_{name}', None)
+        if handler is None:
+            return CommandError(f"unknown command '{name}'")
+        try:
+            return handler(*args)
+        except CommandError as e:
+            return e
+        except (TypeError, ValueError, IndexError):
+            return CommandError(f"wrong arguments for '{name}' command")
+
+    def execute(self, args):
+        name = args[0].decode().lower()
+        if name == 'multi':
+            self.transaction = []
+            return self.send('OK')
+        if name == 'discard':
+            self.transaction = None
+            return self.send('OK')
+        if name == 'exec':
+            queued, self.transaction = self.transaction or [], None
+            return self.send([self.call(queued_name, queued_args) for queued_name, queued_args in queued])
+        if self.transaction is not None:
+            self.transaction.append((name, args[1:]))
+            return self.send('QUEUED')
+        if name == 'subscribe':
+            return self.subscribe(args[1:])
+        if name == 'unsubscribe':
+            return self.unsubscribe(args[1:])
+        if name == 'publish':
+            return self.send(self.publish(args[1], args[2]))
+        if name == 'ping' and self.subscriptions:
+            return self.send([b'pong', args[1] if len(args) > 1 else b''])
+        self.send(self.call(name, args[1:]))
+
+    async def serve(self):
+        try:
+            while True:
+                args = await self.read_command()
+                if args is None:
+                    break
+                if args:
+                    self.execute(args)
+                await self.writer.drain()
+        except (ConnectionError, ProtocolError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in self.subscriptions:
+                self.store.channels.get(channel, set()).discard(self)
+            self.writer.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6399)
+    args = parser.parse_args()
+
+    store = Store()
+    server = await asyncio.start_server(
+        lambda reader, writer: Connection(store, reader, writer).serve(),
+        args.host,
+        args.port
+    )
+    print(f'RESP broker listening on {args.host}:{args.port}', flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
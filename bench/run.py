@@ -0,0 +1,106 @@
+"""Run the benchmark scenarios against a local app.py and write JSON results.
+
+Each scenario starts its own app.py in a scratch directory with the rate
+limits off, drives it from this process and reads the server's CPU and
+memory from /proc (so Linux only):
+
+    chat   join storm, message fan-out and disconnect storm over Socket.IO
+    files  concurrent uploads, full and byte-range downloads per DOWNLOAD_MODE
+    ai     /api/ai/chat against bench/mock_groq.py, plain, cached and streamed
+
+    python bench/run.py --out before.json
+    python bench/run.py --scenarios chat --clients 2000 --env MESSAGE_BATCH_MS=20 --out after.json
+    python bench/run.py --scenarios files --modes stream,sendfile
+    python bench/compare.py before.json after.json
+
+Latencies are reported as p50/p99/max/mean in milliseconds.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+import ai_load
+import chat_load
+import file_load
+from common import APP_PATH, raise_file_limit
+
+SCENARIOS = {
+    'chat': chat_load,
+    'files': file_load,
+    'ai': ai_load,
+}
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=APP_PATH.parent,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=APP_PATH.parent,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('-dirty' if dirty else '')
+
+
+def parse_env(items):
+    env = {}
+    for item in items:
+        name, sep, value = item.partition('=')
+        if not sep:
+            raise SystemExit(f'--env expects NAME=VALUE, got {item!r}')
+        env[name] = value
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for app.py, repeatable')
+    parser.add_argument('--out', help='write JSON here as well as to stdout')
+    for scenario in SCENARIOS.values():
+        scenario.add_arguments(parser)
+    args = parser.parse_args()
+
+    names = args.scenarios.split(',')
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+
+    raise_file_limit()
+    env = parse_env(args.env)
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': vars(args)
+        },
+        'results': {}
+    }
+    for name in names:
+        print(f'Running {name}...', file=sys.stderr, flush=True)
+        report['results'][name] = SCENARIOS[name].run(args, env)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()